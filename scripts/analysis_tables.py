@@ -0,0 +1,128 @@
+from data import get_db_cursor, copy_rows
+from sites import registered_domains
+
+import sys
+
+TABLES = ['browser', 'client', 'vpn', 'onion']
+
+# Typed column of {table}_features that holds results->>'<mechanism>', the HSTS tuple is kept as JSONB
+MECHANISM_COLUMNS = {'XSS': 'xss', 'FA': 'fa', 'TLS': 'tls', 'XFO': 'xfo', 'HSTS': 'hsts'}
+
+# The classification in typed columns, the cookie flags are evaluated exactly like the former LIKE filters on
+# cookies::text
+FEATURE_COLUMNS = {
+    'xss': "(results->>'XSS')::smallint",
+    'fa': "(results->>'FA')::smallint",
+    'tls': "(results->>'TLS')::smallint",
+    'xfo': "(results->>'XFO')::smallint",
+    'hsts': "results->'HSTS'",
+    'hsts_age': "(results->'HSTS'->>0)::smallint",
+    'cookie_secure': """cookies::text LIKE '%secure": 1%'""",
+    'cookie_httponly': """cookies::text LIKE '%httponly": 1%'""",
+    'cookie_samesite': """cookies::text LIKE '%samesite": 1%' OR cookies::text LIKE '%samesite": 2%'""",
+}
+
+
+def feature_columns():
+    return ',\n'.join(f'{expression} AS {column}' for column, expression in FEATURE_COLUMNS.items())
+
+
+def cookie_attrs_query(table):
+    # One row per cookie of every crawled response
+    return f"""
+        SELECT
+            '{table}' AS table_name, id AS row_id, test, cluster, end_origin, c.key AS cookie_id, c.value AS attributes,
+            (c.value->>'secure')::smallint AS secure, (c.value->>'httponly')::smallint AS httponly,
+            (c.value->>'samesite')::smallint AS samesite
+        FROM {table}, jsonb_each(cookies) AS c
+    """
+
+
+def create_features(cur, table):
+    # One row per crawled response with the classification in typed columns
+    cur.execute(f"DROP TABLE IF EXISTS {table}_features;")
+    cur.execute(f"""
+        CREATE TABLE {table}_features AS SELECT
+            id, test, cluster, end_origin, end_site, results,
+            {feature_columns()}
+        FROM {table};
+    """)
+    cur.execute(f"CREATE INDEX ON {table}_features (test, cluster);")
+    cur.execute(f"CREATE INDEX ON {table}_features (end_origin);")
+    cur.execute(f"ANALYZE {table}_features;")
+
+
+def create_cookie_attrs(cur, table):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS cookie_attrs (
+            table_name VARCHAR(16),
+            row_id INTEGER,
+            test INTEGER,
+            cluster INTEGER,
+            end_origin VARCHAR(256),
+            cookie_id TEXT,
+            attributes JSONB,
+            secure SMALLINT,
+            httponly SMALLINT,
+            samesite SMALLINT
+        );
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS cookie_attrs_table_idx ON cookie_attrs (table_name, test, cluster);")
+    cur.execute("DELETE FROM cookie_attrs WHERE table_name = %s;", (table,))
+    cur.execute(f"INSERT INTO cookie_attrs {cookie_attrs_query(table)};")
+    cur.execute("ANALYZE cookie_attrs;")
+
+
+def create_origin_sites(cur, tables):
+    # end_origin -> registered domain, origins of earlier runs are kept and only new ones are resolved
+    cur.execute("CREATE TABLE IF NOT EXISTS origin_sites (origin VARCHAR(256) PRIMARY KEY, site VARCHAR(256));")
+    origins = ' UNION '.join(f'SELECT end_origin FROM {table}' for table in tables)
+    cur.execute(f"""
+        SELECT end_origin FROM ({origins}) AS o
+        WHERE end_origin IS NOT NULL AND end_origin NOT IN (SELECT origin FROM origin_sites);
+    """)
+    copy_rows(cur, 'origin_sites', ['origin', 'site'], registered_domains(o for o, in cur.fetchall()).items())
+    cur.execute("ANALYZE origin_sites;")
+
+
+def watermark(cur, table):
+    # Changes of the table according to the statistics of PostgreSQL, TRUNCATE gives the table a new file node. The
+    # statistics are only ever behind the committed rows, so a build never records changes it did not see.
+    cur.execute("""
+        SELECT pg_relation_filenode(relid) || ':' || (n_tup_ins + n_tup_upd + n_tup_del)
+        FROM pg_stat_user_tables WHERE relid = %s::regclass;
+    """, (table,))
+    return cur.fetchone()[0]
+
+
+def materialize(tables=None, refresh=False):
+    # Only the tables whose source changed since they were built are rebuilt, or all of them with refresh
+    tables = tables or TABLES
+    cur = get_db_cursor()
+    cur.execute("CREATE TABLE IF NOT EXISTS analysis_watermarks (table_name VARCHAR(16) PRIMARY KEY, watermark TEXT);")
+    cur.execute("SELECT table_name, watermark FROM analysis_watermarks;")
+    built = dict(cur.fetchall())
+    # The watermark is taken before the build, such that changes during the build cause a rebuild next time
+    watermarks = {table: watermark(cur, table) for table in tables}
+    stale = [table for table in tables if refresh or built.get(table) != watermarks[table]]
+    if stale:
+        print('Materializing origin_sites...')
+        create_origin_sites(cur, stale)
+    for table in stale:
+        print(f'Materializing {table}_features...')
+        create_features(cur, table)
+        print(f'Materializing cookie_attrs of {table}...')
+        create_cookie_attrs(cur, table)
+        cur.execute("""
+            INSERT INTO analysis_watermarks VALUES (%s, %s)
+            ON CONFLICT (table_name) DO UPDATE SET watermark = excluded.watermark;
+        """, (table, watermarks[table]))
+    for table in tables:
+        if table not in stale:
+            print(f'{table}_features and its cookie_attrs are up to date')
+    cur.connection.close()
+
+
+if __name__ == '__main__':
+    # Usage: python3 analysis_tables.py [table ...], rebuilds the analysis tables even if they are up to date
+    materialize(sys.argv[1:], refresh=True)
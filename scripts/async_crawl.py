@@ -0,0 +1,138 @@
+from doCrawl import MAX_BODY_SIZE, CHUNK_SIZE, SESSION_REUSE, FRESH_CONNECTION
+from concurrent.futures import ThreadPoolExecutor
+from aiohttp_socks import ProxyConnector
+from body_store import get_body_store
+from data import UserAgents
+
+import aiohttp
+import asyncio
+import socket
+import json
+
+DEBUG = False
+
+# Same request defaults as requests, such that both fetch engines look identical to the server
+DEFAULT_HEADERS = {
+    'Accept-Encoding': 'gzip, deflate',
+    'Accept': '*/*',
+    'Connection': 'keep-alive'
+}
+
+# Timeout values (mirror doCrawl.crawl and the KILL value of crawl.py)
+REQUEST_TIMEOUT = 20
+KILL = 30
+
+
+def get_peer_info(transport):
+    peer = None
+    tls_version = None
+    try:
+        peername = transport.get_extra_info('peername')
+        if peername:
+            peer = '%s:%s' % peername[:2]
+        ssl_object = transport.get_extra_info('ssl_object')
+        if ssl_object is not None:
+            tls_version = ssl_object.version()
+    except Exception as exp:
+        if DEBUG:
+            print('Socket Error:', str(exp))
+    return peer, tls_version
+
+
+class PeerInfoResponse(aiohttp.ClientResponse):
+    # aiohttp releases the connection as soon as the body is complete, so read the socket details up front
+    peer = None
+    tls_version = None
+
+    async def start(self, connection):
+        self.peer, self.tls_version = get_peer_info(connection.transport)
+        return await super().start(connection)
+
+
+async def read_body(r, executor):
+    # Streamed into the body store like in doCrawl.crawl, the writer runs in the executor next to the loop
+    writer = get_body_store().writer()
+    writing = None
+    truncated = False
+    try:
+        async for chunk in r.content.iter_chunked(CHUNK_SIZE):
+            if writer.size + len(chunk) > MAX_BODY_SIZE:
+                writing = executor.submit(writer.write, chunk[:MAX_BODY_SIZE - writer.size])
+                await asyncio.wrap_future(writing)
+                truncated = True
+                break
+            writing = executor.submit(writer.write, chunk)
+            await asyncio.wrap_future(writing)
+        writing = executor.submit(writer.commit)
+        return await asyncio.wrap_future(writing), truncated
+    except BaseException:
+        # A cancelled fetch may still be writing, so the writer is only discarded once that is done
+        if writing is None:
+            writer.abort()
+        else:
+            writing.add_done_callback(lambda _: writer.abort())
+        raise
+
+
+class AsyncCrawler:
+    """Keeps up to `concurrency` fetches in flight, each one returning the same result as doCrawl.crawl."""
+
+    def __init__(self, concurrency):
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.connectors = dict()
+        self.executor = ThreadPoolExecutor()
+
+    def get_connector(self, proxies):
+        proxy = None if proxies is None else proxies['https']
+        if proxy not in self.connectors:
+            # The semaphore bounds the in-flight requests, so the connectors themselves are unlimited
+            force_close = FRESH_CONNECTION or not SESSION_REUSE
+            if proxy is None:
+                self.connectors[proxy] = aiohttp.TCPConnector(family=socket.AF_INET, force_close=force_close, limit=0)
+            else:
+                self.connectors[proxy] = ProxyConnector.from_url(proxy, family=socket.AF_INET, force_close=force_close,
+                                                                 limit=0)
+        return self.connectors[proxy]
+
+    async def fetch(self, url, proxies, headers):
+        # A fresh cookie jar per fetch keeps samples independent, while redirects still see their cookies
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=REQUEST_TIMEOUT, sock_read=REQUEST_TIMEOUT)
+        async with aiohttp.ClientSession(connector=self.get_connector(proxies), connector_owner=False,
+                                         cookie_jar=aiohttp.CookieJar(unsafe=True), timeout=timeout,
+                                         response_class=PeerInfoResponse) as session:
+            async with session.get(url, headers=headers) as r:
+                fingerprint, truncated = await read_body(r, self.executor)
+        return r, r.peer, r.tls_version, fingerprint, truncated
+
+    async def crawl(self, url, proxies=None, headers=None, user_agent=UserAgents['chrome']['windows']):
+        request_headers = dict(DEFAULT_HEADERS)
+        if headers is not None:
+            request_headers.update(headers)
+        request_headers['User-Agent'] = user_agent
+        async with self.semaphore:
+            try:
+                r, peer, tls_version, fingerprint, truncated = await asyncio.wait_for(
+                    self.fetch(url, proxies, request_headers), KILL)
+            except asyncio.TimeoutError:
+                return [False, f'TimeoutError: asyncio.wait_for({KILL})']
+            except Exception as exp:
+                return [False, str(exp)]
+
+        if DEBUG:
+            print(f'Application-Fingerprint is: {fingerprint}')
+
+        result_data = [str(r.url), peer, tls_version, fingerprint]
+        # requests joins repeated headers (e.g. set-cookie) with ', ', parsers.py relies on that
+        response_headers = {h.lower(): ', '.join(r.headers.getall(h)) for h in r.headers}
+        response_headers['status_code'] = r.status
+        if truncated:
+            response_headers['body_truncated'] = True
+        result_data.append(json.dumps(response_headers))
+
+        return [True, result_data]
+
+    async def close(self):
+        for connector in self.connectors.values():
+            await connector.close()
+        self.connectors = dict()
+        self.executor.shutdown()
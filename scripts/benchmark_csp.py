@@ -0,0 +1,50 @@
+from parsers import parse_csp, normalize_csp, classify_policy
+from data import get_streaming_cursor
+
+import time
+import sys
+
+# Usage: python3 benchmark_csp.py [table] [limit]
+TABLE = sys.argv[1] if len(sys.argv) > 1 else 'browser'
+LIMIT = int(sys.argv[2]) if len(sys.argv) > 2 else 1000000
+
+
+def load_corpus(table, limit):
+    corpus = list()
+    with get_streaming_cursor('csp_corpus', 10000) as rows:
+        rows.execute(f"""
+            SELECT end_url, headers->>'content-security-policy' FROM {table}
+            WHERE headers ? 'content-security-policy' LIMIT %s;
+        """, (limit,))
+        for end_url, csp in rows:
+            origin = '/'.join(end_url.split('#')[0].split('?')[0].split('/')[:3])
+            corpus.append((origin, csp))
+    return corpus
+
+
+def measure(name, parse, corpus):
+    start = time.perf_counter()
+    results = [parse(origin, csp) for origin, csp in corpus]
+    duration = time.perf_counter() - start
+    print(f'{name}: {len(corpus) / duration:,.0f} policies/s ({duration:.2f}s)')
+    return results
+
+
+def main():
+    corpus = load_corpus(TABLE, LIMIT)
+    print(f'Loaded {len(corpus)} policies from {TABLE}.')
+    if not corpus:
+        return
+    uncached = measure('uncached', lambda origin, csp: dict(classify_policy.__wrapped__(origin, normalize_csp(csp))),
+                       corpus)
+    classify_policy.cache_clear()
+    cached = measure('cached (cold)', parse_csp, corpus)
+    measure('cached (warm)', parse_csp, corpus)
+    info = classify_policy.cache_info()
+    print(f'Cache: {info.currsize} entries, hit rate {info.hits / (info.hits + info.misses):.1%}')
+    if uncached != cached:
+        print('ERROR: cached and uncached results differ!')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,314 @@
+from collections import OrderedDict
+from hashlib import md5
+
+import zstandard
+import threading
+import fcntl
+import sqlite3
+import random
+import socket
+import gzip
+import time
+import sys
+import os
+
+DATA_DIRECTORY = '/data'
+
+# gzip: one <md5>.html.gz file per body (default) | pack: append-only zstd pack files with an SQLite index
+BODY_STORE = os.environ.get('BODY_STORE', 'gzip')
+if BODY_STORE not in ['gzip', 'pack']:
+    print('BODY_STORE has to be either gzip or pack! Abort.')
+    exit(-1)
+
+PACK_DIRECTORY = f'{DATA_DIRECTORY}/packs'
+# Writers start a new pack file once theirs is larger than this
+PACK_SIZE = 1 << 30
+# Readers keep at most this many pack files open, the least recently read one is closed first
+PACK_OPEN_FILES = 64
+ZSTD_LEVEL = 9
+# Size of a trained dictionary and number of bodies it is trained on
+DICT_SIZE = 112 * 1024
+DICT_SAMPLES = 10000
+
+
+class GzipFileStore:
+    """The original layout: /data/<h[0]>/<h[1]>/<h>.html.gz"""
+
+    def __init__(self, directory=DATA_DIRECTORY):
+        self.directory = directory
+
+    def path(self, content_hash):
+        return f'{self.directory}/{content_hash[0]}/{content_hash[1]}/{content_hash}.html.gz'
+
+    def exists(self, content_hash):
+        return os.path.exists(self.path(content_hash))
+
+    def temporary_path(self):
+        # Unique per host, process and thread, the async crawl mode stores bodies from several threads
+        os.makedirs(f'{self.directory}/tmp', exist_ok=True)
+        name = f'{socket.gethostname()}-{os.getpid()}-{threading.get_ident()}-{time.time_ns()}'
+        return f'{self.directory}/tmp/{name}.part'
+
+    def put(self, content_hash, content):
+        if self.exists(content_hash):
+            return False
+        # Written to a temporary file first, such that no reader ever sees a truncated <h>.html.gz
+        path = self.temporary_path()
+        try:
+            with gzip.open(path, 'wb') as fh:
+                fh.write(content)
+            os.makedirs(os.path.dirname(self.path(content_hash)), exist_ok=True)
+            os.replace(path, self.path(content_hash))
+        except BaseException:
+            if os.path.exists(path):
+                os.remove(path)
+            raise
+        return True
+
+    def get(self, content_hash):
+        if not self.exists(content_hash):
+            raise KeyError(f'File {content_hash} not found')
+        with gzip.open(self.path(content_hash), 'rb') as fh:
+            return fh.read()
+
+    def writer(self):
+        return BodyWriter(self)
+
+    def keys(self):
+        for root, _, files in os.walk(self.directory):
+            for file in files:
+                if file.endswith('.html.gz'):
+                    yield file[:-len('.html.gz')]
+
+    def close(self):
+        pass
+
+
+class BodyWriter:
+    """Hashes a body chunk by chunk while it is downloaded, it is only compressed and written on commit if it is new.
+
+    The body is kept in memory until then, which the callers bound by MAX_BODY_SIZE.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.hasher = md5()
+        self.size = 0
+        self.chunks = list()
+
+    def write(self, chunk):
+        self.hasher.update(chunk)
+        self.chunks.append(chunk)
+        self.size += len(chunk)
+
+    def commit(self):
+        content_hash = self.hasher.hexdigest()
+        self.store.put(content_hash, b''.join(self.chunks))
+        self.chunks = list()
+        return content_hash
+
+    def abort(self):
+        self.chunks = list()
+
+
+class PackStore:
+    """Bodies are zstd frames appended to pack files, the index maps md5 -> (pack, offset, length).
+
+    Packs are named <host>-<slot>.pack. A writing process holds an exclusive flock on the pack it appends to, which
+    the kernel releases when the process dies, so a restarted crawl child continues the pack of its predecessor
+    instead of starting a new one. A frame is only indexed after it was written completely, such that a killed writer
+    merely leaves unreferenced bytes at the end of its pack.
+    """
+
+    def __init__(self, directory=PACK_DIRECTORY):
+        self.directory = directory
+        os.makedirs(f'{directory}/dicts', exist_ok=True)
+        self.db = sqlite3.connect(f'{directory}/index.sqlite', timeout=600, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL;')
+        self.db.execute('PRAGMA synchronous=NORMAL;')
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS bodies (
+                hash TEXT PRIMARY KEY,
+                pack TEXT,
+                offset INTEGER,
+                length INTEGER,
+                dict_id INTEGER
+            );
+        """)
+        self.db.commit()
+        # The async crawl mode stores bodies from several threads
+        self.lock = threading.Lock()
+        self.dicts = dict()
+        self.local = threading.local()
+        self.dict_id = None
+        self.pack = None
+        self.pack_name = None
+        # pack name -> fd, in the order of the last read
+        self.packs = OrderedDict()
+
+    def load_dict(self, dict_id):
+        if dict_id not in self.dicts:
+            with open(f'{self.directory}/dicts/{dict_id}.zdict', 'rb') as fh:
+                self.dicts[dict_id] = zstandard.ZstdCompressionDict(fh.read())
+        return self.dicts[dict_id]
+
+    def new_compressor(self):
+        if self.dict_id is None:
+            # Compress with the most recently trained dictionary, older ones stay available for reading
+            trained = [int(name.split('.')[0]) for name in os.listdir(f'{self.directory}/dicts')
+                       if name.endswith('.zdict')]
+            self.dict_id = max(trained, key=lambda d: os.path.getmtime(f'{self.directory}/dicts/{d}.zdict'),
+                               default=0)
+        if self.dict_id:
+            return zstandard.ZstdCompressor(level=ZSTD_LEVEL, dict_data=self.load_dict(self.dict_id))
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL)
+
+    def get_compressor(self):
+        # Compressors must not be shared between threads
+        if not hasattr(self.local, 'compressor'):
+            self.local.compressor = self.new_compressor()
+        return self.local.compressor
+
+    def get_pack(self):
+        if self.pack is None or self.pack.tell() > PACK_SIZE:
+            if self.pack is not None:
+                self.pack.close()
+            self.pack_name, self.pack = self.open_pack()
+        return self.pack
+
+    def open_pack(self):
+        # The first pack of this host that no other writer holds and that still has room
+        slot = 0
+        while True:
+            name = f'{socket.gethostname()}-{slot}.pack'
+            pack = open(f'{self.directory}/{name}', 'ab')
+            try:
+                fcntl.flock(pack, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                pack.close()
+            else:
+                if pack.tell() <= PACK_SIZE:
+                    return name, pack
+                pack.close()
+            slot += 1
+
+    def exists(self, content_hash):
+        with self.lock:
+            return self.db.execute('SELECT 1 FROM bodies WHERE hash=?', (content_hash,)).fetchone() is not None
+
+    def put(self, content_hash, content):
+        if self.exists(content_hash):
+            return False
+        # Compress outside of the lock, it is by far the most expensive part
+        self.append(content_hash, self.get_compressor().compress(content))
+        return True
+
+    def append(self, content_hash, frame):
+        with self.lock:
+            if self.db.execute('SELECT 1 FROM bodies WHERE hash=?', (content_hash,)).fetchone() is not None:
+                return
+            pack = self.get_pack()
+            offset = pack.tell()
+            pack.write(frame)
+            pack.flush()
+            self.db.execute('INSERT OR IGNORE INTO bodies VALUES (?, ?, ?, ?, ?)',
+                            (content_hash, self.pack_name, offset, len(frame), self.dict_id))
+            self.db.commit()
+
+    def writer(self):
+        return BodyWriter(self)
+
+    def get(self, content_hash):
+        with self.lock:
+            row = self.db.execute('SELECT pack, offset, length, dict_id FROM bodies WHERE hash=?',
+                                  (content_hash,)).fetchone()
+            if row is None:
+                raise KeyError(f'File {content_hash} not found')
+            pack, offset, length, dict_id = row
+            if pack in self.packs:
+                self.packs.move_to_end(pack)
+            else:
+                if len(self.packs) >= PACK_OPEN_FILES:
+                    os.close(self.packs.popitem(last=False)[1])
+                self.packs[pack] = os.open(f'{self.directory}/{pack}', os.O_RDONLY)
+            # Read under the lock, another thread may close the fd once it is the least recently used one
+            frame = os.pread(self.packs[pack], length, offset)
+        # Streamed frames do not carry their content size, so always decompress as a stream
+        if dict_id:
+            return zstandard.ZstdDecompressor(dict_data=self.load_dict(dict_id)).decompressobj().decompress(frame)
+        return zstandard.ZstdDecompressor().decompressobj().decompress(frame)
+
+    def keys(self):
+        with self.lock:
+            rows = self.db.execute('SELECT hash FROM bodies').fetchall()
+        for content_hash, in rows:
+            yield content_hash
+
+    def close(self):
+        with self.lock:
+            if self.pack is not None:
+                self.pack.close()
+                self.pack = None
+            for fd in self.packs.values():
+                os.close(fd)
+            self.packs = OrderedDict()
+            self.db.close()
+
+
+BACKENDS = {
+    'gzip': GzipFileStore,
+    'pack': PackStore,
+}
+
+# pid -> store, such that forked workers and crawl children never share file handles or the SQLite connection
+_stores = dict()
+
+
+def get_body_store():
+    if os.getpid() not in _stores:
+        _stores[os.getpid()] = BACKENDS[BODY_STORE]()
+    return _stores[os.getpid()]
+
+
+def store_body(content):
+    # Lookup before write: a body served to many user agents is compressed and written only once
+    content_hash = md5(content).hexdigest()
+    get_body_store().put(content_hash, content)
+    return content_hash
+
+
+def load_body(content_hash):
+    return get_body_store().get(content_hash)
+
+
+def train_dictionary(source):
+    # Trains a zstd dictionary on bodies of the given store, new pack writers pick it up on their next start
+    source = BACKENDS[source]()
+    hashes = list(source.keys())
+    samples = [source.get(content_hash) for content_hash in random.sample(hashes, min(DICT_SAMPLES, len(hashes)))]
+    print(f'Training dictionary on {len(samples)} bodies ...')
+    dictionary = zstandard.train_dictionary(DICT_SIZE, samples, level=ZSTD_LEVEL)
+    os.makedirs(f'{PACK_DIRECTORY}/dicts', exist_ok=True)
+    with open(f'{PACK_DIRECTORY}/dicts/{dictionary.dict_id()}.zdict', 'wb') as fh:
+        fh.write(dictionary.as_bytes())
+    print(f'Stored dictionary {dictionary.dict_id()}.')
+
+
+def migrate(source, target):
+    source, target = BACKENDS[source](), BACKENDS[target]()
+    count = 0
+    for content_hash in source.keys():
+        if not target.exists(content_hash):
+            target.put(content_hash, source.get(content_hash))
+            count += 1
+    target.close()
+    print(f'Migrated {count} bodies.')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 3 and sys.argv[1] == 'train':
+        train_dictionary(sys.argv[2])
+    elif len(sys.argv) == 4 and sys.argv[1] == 'migrate':
+        migrate(sys.argv[2], sys.argv[3])
+    else:
+        print(f'Usage: {sys.argv[0]} train <gzip|pack> | migrate <gzip|pack> <gzip|pack>')
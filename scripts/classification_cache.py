@@ -0,0 +1,85 @@
+from collections import OrderedDict
+from multiprocessing import Manager
+from parsers import normalize_csp
+
+import hashlib
+import json
+
+# Headers that classify_worker turns into results and cookies
+CLASSIFIED_HEADERS = ['x-frame-options', 'strict-transport-security', 'content-security-policy', 'set-cookie']
+
+# Entries kept per process, and in the table shared by all processes before it is reset
+LOCAL_CACHE_SIZE = 100000
+SHARED_CACHE_SIZE = 1000000
+# Number of shared lookups between two size checks of the shared table
+SHARED_CHECK_INTERVAL = 1000
+
+
+def get_header_fingerprint(end_url, headers):
+    # Classification only depends on the origin and these headers, CSP nonces and report endpoints are irrelevant
+    origin = '/'.join(end_url.split('#')[0].split('?')[0].split('/')[:3])
+    values = [headers.get(h, None) for h in CLASSIFIED_HEADERS]
+    csp = CLASSIFIED_HEADERS.index('content-security-policy')
+    if values[csp] is not None:
+        values[csp] = normalize_csp(values[csp])
+    return hashlib.md5(json.dumps([origin] + values).encode()).digest()
+
+
+class ClassificationCache:
+    """(results, cookies) by header fingerprint, in a per-process LRU backed by a table shared through a Manager.
+
+    The shared table only exists if `start_shared` was called before the worker processes are forked.
+    """
+
+    def __init__(self, size=LOCAL_CACHE_SIZE):
+        self.size = size
+        self.local = OrderedDict()
+        self.manager = None
+        self.shared = None
+        self.lookups = 0
+        self.local_hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+
+    def start_shared(self):
+        self.manager = Manager()
+        self.shared = self.manager.dict()
+
+    def remember(self, fingerprint, value):
+        self.local[fingerprint] = value
+        if len(self.local) > self.size:
+            self.local.popitem(last=False)
+
+    def get(self, fingerprint, classify):
+        if fingerprint in self.local:
+            self.local.move_to_end(fingerprint)
+            self.local_hits += 1
+            return self.local[fingerprint]
+        value = None
+        if self.shared is not None:
+            self.lookups += 1
+            if self.lookups % SHARED_CHECK_INTERVAL == 0 and len(self.shared) > SHARED_CACHE_SIZE:
+                self.shared.clear()
+            value = self.shared.get(fingerprint)
+        if value is not None:
+            self.shared_hits += 1
+        else:
+            self.misses += 1
+            value = classify()
+            if self.shared is not None:
+                self.shared[fingerprint] = value
+        self.remember(fingerprint, value)
+        return value
+
+    def report(self, name):
+        total = self.local_hits + self.shared_hits + self.misses
+        if total == 0:
+            return
+        print(f'{name}: classification cache hit rate {(self.local_hits + self.shared_hits) / total:.1%} '
+              f'({self.local_hits} local, {self.shared_hits} shared, {self.misses} classified)')
+
+    def close(self):
+        if self.manager is not None:
+            self.manager.shutdown()
+            self.manager = None
+            self.shared = None
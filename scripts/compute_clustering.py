@@ -1,14 +1,196 @@
-from similarity import similarity, build_full_cache
-from collections import defaultdict
-from data import get_db_cursor
+from similarity import similarity, build_full_cache, fetch_script_stats, DomainFeatures, SIMILARITY_CACHE_STATS
+from data import get_db_cursor, get_scoped_db_cursor, copy_rows
+from multiprocessing import Pool
 
+import time
+import sys
+import os
+
+PROCESSES = os.environ.get('NUM_PROCESSES', None)
+if PROCESSES is None:
+    print('Environment variable NUM_PROCESSES is not defined! Using only ONE Process.')
+    PROCESSES = 1
+else:
+    try:
+        PROCESSES = int(PROCESSES)
+    except ValueError:
+        print('NUM_PROCESSES is not an integer! Abort.')
+        exit(-1)
+
+TABLES = ['client', 'browser', 'vpn', 'onion']
 SIMILARITY_THRESHOLD = 0.8
 
+# Cursors for script_stats that are missing in SCRIPT_STAT_CACHE, connections cannot be shared with forked workers
+_sim_cursors = dict()
+
+
+def cluster_domain(cur_sim, hashes, known_clusters=None):
+    # Greedy: a hash joins the first cluster whose members are all similar to it, otherwise it opens a new cluster.
+    # Clusters with a member that cannot reach the threshold are skipped before any exact score is computed.
+    # known_clusters (cluster -> members) of an earlier run are kept as they are, only new hashes are added.
+    known_clusters = known_clusters or dict()
+    known = {h for members in known_clusters.values() for h in members}
+    hashes = [h for members in known_clusters.values() for h in members] + [h for h in hashes if h not in known]
+    features = DomainFeatures([fetch_script_stats(cur_sim, h) for h in hashes])
+    clusters = dict()
+    for c in sorted(known_clusters):
+        clusters[c] = [i for i, h in enumerate(hashes) if h in known_clusters[c]]
+    for i in range(len(known), len(hashes)):
+        h = hashes[i]
+        candidates = features.candidates(i, SIMILARITY_THRESHOLD)
+        determined_cluster = None
+        for c, members in clusters.items():
+            if not candidates[members].all():
+                continue
+            for j in members:
+                if similarity(cur_sim, h, hashes[j]) < SIMILARITY_THRESHOLD:
+                    break
+            else:
+                # No Break => Found matching cluster
+                determined_cluster = c
+                break
+        if determined_cluster is None:
+            clusters[max(clusters, default=0) + 1] = [i]
+        else:
+            clusters[determined_cluster].append(i)
+    return {c: {hashes[j] for j in members} for c, members in clusters.items()}
+
+
+def get_sim_cursor():
+    pid = os.getpid()
+    if pid not in _sim_cursors:
+        _sim_cursors[pid] = get_db_cursor()
+    return _sim_cursors[pid]
+
+
+def cluster_worker(job):
+    table, domain, hashes, known_clusters = job
+    hits, misses = SIMILARITY_CACHE_STATS['hits'], SIMILARITY_CACHE_STATS['misses']
+    clusters = cluster_domain(get_sim_cursor(), hashes, known_clusters)
+    # The similarity cache lives in the worker, its statistics are summed up by the parent
+    cache_stats = SIMILARITY_CACHE_STATS['hits'] - hits, SIMILARITY_CACHE_STATS['misses'] - misses
+    return domain, len(clusters), [(table, h, c) for c, entries in clusters.items() for h in entries], cache_stats
+
+
+def create_cluster_members():
+    # Members of every cluster per (table, domain), such that later incremental runs can extend the clusters
+    cur = get_db_cursor()
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS cluster_members (
+            table_name VARCHAR(16),
+            domain VARCHAR(64),
+            cluster INTEGER,
+            file_name_hash VARCHAR(32)
+        );
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS cluster_members_domain_idx ON cluster_members (table_name, domain);")
+    cur.connection.close()
+
+
+def save_cluster_members(cur, table, members, replace):
+    if replace:
+        cur.execute("DELETE FROM cluster_members WHERE table_name = %s;", (table,))
+    copy_rows(cur, 'cluster_members', ['table_name', 'domain', 'cluster', 'file_name_hash'],
+              ((table, domain, cluster_id, h) for domain, cluster_id, h in members))
+
+
+def bootstrap_cluster_members(cur, table, domains, known_clusters):
+    # Domains clustered before cluster_members existed: their members are taken from the clustered rows, such that
+    # new hashes join the existing clusters and never reuse their ids
+    cur.execute(f"""
+        SELECT domain, cluster, array_agg(DISTINCT file_name_hash) FROM {table}
+        WHERE cluster IS NOT NULL AND domain = ANY(%s) GROUP BY 1, 2;
+    """, (domains,))
+    members = list()
+    for domain, cluster_id, hashes in cur.fetchall():
+        known_clusters[domain][cluster_id] = set(hashes)
+        members.extend((domain, cluster_id, h) for h in hashes)
+    if members:
+        print(f'Took the members of {len(members)} clustered hashes from {table}')
+        save_cluster_members(cur, table, members, replace=False)
+
+
+def apply_clusters(table, assignments, members):
+    # A single transaction, such that the table is never seen half clustered. The index on cluster is kept, dropping
+    # it would lock the table exclusively and block the inserts of running crawlers until the commit.
+    with get_scoped_db_cursor(autocommit=False) as cur:
+        save_cluster_members(cur, table, members, replace=True)
+        cur.execute(f"""
+            CREATE TEMPORARY TABLE {table}_clusters (file_name_hash VARCHAR(32) PRIMARY KEY, cluster INTEGER)
+            ON COMMIT DROP;
+        """)
+        copy_rows(cur, f'{table}_clusters', ['file_name_hash', 'cluster'], assignments.items())
+        cur.execute(f"""
+            UPDATE {table} AS t SET cluster = c.cluster FROM {table}_clusters AS c
+            WHERE t.file_name_hash = c.file_name_hash AND t.cluster IS DISTINCT FROM c.cluster;
+        """)
+        print(f'Updated the cluster of {cur.rowcount} rows')
+        cur.connection.commit()
+
+
+def apply_incremental_clusters(table, assignments, members):
+    # Only rows without a cluster are touched, every (domain, hash) gets the cluster of its domain
+    with get_scoped_db_cursor(autocommit=False) as cur:
+        save_cluster_members(cur, table, members, replace=False)
+        cur.execute(f"""
+            CREATE TEMPORARY TABLE {table}_clusters (domain VARCHAR(64), file_name_hash VARCHAR(32), cluster INTEGER)
+            ON COMMIT DROP;
+        """)
+        copy_rows(cur, f'{table}_clusters', ['domain', 'file_name_hash', 'cluster'],
+                  ((domain, h, cluster_id) for (domain, h), cluster_id in assignments.items()))
+        cur.execute(f"""
+            UPDATE {table} AS t SET cluster = c.cluster FROM {table}_clusters AS c
+            WHERE t.cluster IS NULL AND t.domain = c.domain AND t.file_name_hash = c.file_name_hash;
+        """)
+        print(f'Updated the cluster of {cur.rowcount} rows')
+        cur.connection.commit()
+
+
+def cluster_incremental(table):
+    cur = get_db_cursor()
+    # Hashes without script_stats stay unclustered until their body was parsed
+    cur.execute(f"""
+        SELECT domain, array_agg(DISTINCT file_name_hash) FROM {table} WHERE cluster IS NULL AND file_name_hash IN (
+            SELECT file_name_hash FROM script_stats
+        ) GROUP BY 1;
+    """)
+    raw_data = cur.fetchall()
+    if not raw_data:
+        cur.connection.close()
+        return
+    known_clusters = {domain: dict() for domain, _ in raw_data}
+    cur.execute("""
+        SELECT domain, cluster, array_agg(file_name_hash) FROM cluster_members
+        WHERE table_name = %s AND domain = ANY(%s) GROUP BY 1, 2;
+    """, (table, list(known_clusters)))
+    for domain, cluster_id, hashes in cur.fetchall():
+        known_clusters[domain][cluster_id] = set(hashes)
+    bootstrap_cluster_members(cur, table, [domain for domain, clusters in known_clusters.items() if not clusters],
+                              known_clusters)
+    cur.connection.close()
+    needed = {h for _, hashes in raw_data for h in hashes}
+    needed.update(h for clusters in known_clusters.values() for members in clusters.values() for h in members)
+    build_full_cache(table, needed)
+    print(f'Clustering {len(raw_data)} domains of {table} with new hashes...')
+    # (domain, file_name_hash) -> cluster for the unclustered rows, and the hashes that joined a cluster
+    assignments = dict()
+    members = list()
+    unclustered = {domain: set(hashes) for domain, hashes in raw_data}
+    jobs = [(table, domain, hashes, known_clusters[domain]) for domain, hashes in raw_data]
+    with Pool(PROCESSES) as pool:
+        for domain, _, domain_assignments, _ in pool.imap(cluster_worker, jobs, chunksize=16):
+            for _, h, cluster_id in domain_assignments:
+                if h not in known_clusters[domain].get(cluster_id, ()):
+                    members.append((domain, cluster_id, h))
+                if h in unclustered[domain]:
+                    assignments[(domain, h)] = cluster_id
+    apply_incremental_clusters(table, assignments, members)
+
 
 def cluster():
+    create_cluster_members()
     cur = get_db_cursor()
-    cur_sim = get_db_cursor()
-    for table in ['client', 'browser', 'vpn', 'onion']:
+    for table in TABLES:
         build_full_cache(table)
         print(f'Start clustering for {table}...')
         cur.execute(f"""
@@ -22,32 +204,24 @@ def cluster():
         print(f'Got {len(raw_data)} domains!')
         similar = set()
         multiple = set()
-        for domain, hashes in raw_data:
-            clusters = defaultdict(set)
-            for h in hashes:
-                if len(clusters.keys()) == 0:
-                    clusters[1] = {h}
-                    continue
-                determined_cluster = None
-                for c, entries in clusters.items():
-                    for e in entries:
-                        if similarity(cur_sim, h, e) < SIMILARITY_THRESHOLD:
-                            break
-                    else:
-                        # No Break => Found matching cluster
-                        determined_cluster = c
-                        break
-                if determined_cluster is None:
-                    clusters[max(clusters.keys()) + 1] = {h}
+        # file_name_hash -> cluster, a hash of several domains keeps the cluster of the last one like before
+        assignments = dict()
+        members = list()
+        hits, misses = 0, 0
+        jobs = [(table, domain, hashes, None) for domain, hashes in raw_data]
+        # Workers are forked after build_full_cache, such that they inherit the script_stats of this table
+        with Pool(PROCESSES) as pool:
+            for domain, num_clusters, domain_assignments, cache_stats in pool.imap(cluster_worker, jobs,
+                                                                                    chunksize=16):
+                hits += cache_stats[0]
+                misses += cache_stats[1]
+                if num_clusters == 1:
+                    similar.add(domain)
                 else:
-                    clusters[determined_cluster].add(h)
-            if len(clusters.keys()) == 1:
-                similar.add(domain)
-            else:
-                multiple.add(domain)
-            for cluster_id, entries in clusters.items():
-                hash_list = str(entries).replace('{', '(').replace('}', ')')
-                cur.execute(f"UPDATE {table} SET cluster = %s WHERE file_name_hash IN {hash_list};", (cluster_id,))
+                    multiple.add(domain)
+                for _, h, cluster_id in domain_assignments:
+                    assignments[h] = cluster_id
+                    members.append((domain, cluster_id, h))
         cur.execute(f"""
             SELECT domain, h[1] FROM (
                 SELECT domain, array_agg(DISTINCT file_name_hash) AS h FROM {table} WHERE file_name_hash IN (
@@ -56,13 +230,33 @@ def cluster():
             ) AS foo WHERE array_length(h, 1) = 1;
         """)
         unique_responses = cur.fetchall()
-        for _, file_hash in unique_responses:
-            cur.execute(f"UPDATE {table} SET cluster = 1 WHERE file_name_hash = %s;", (file_hash,))
+        for domain, file_hash in unique_responses:
+            assignments[file_hash] = 1
+            members.append((domain, 1, file_hash))
+        if assignments:
+            apply_clusters(table, assignments, members)
 
         print(f'Only Unique Responses: {len(unique_responses)}')
         print(f'Only Similar Responses: {len(similar)}')
         print(f'Multiple Different Responses: {len(multiple)}')
+        if hits + misses:
+            print(f'Similarity cache hit rate: {hits / (hits + misses):.1%} ({hits} hits, {misses} misses)')
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == 'incremental':
+        # Usage: python3 compute_clustering.py incremental [interval in seconds]
+        create_cluster_members()
+        interval = int(sys.argv[2]) if len(sys.argv) > 2 else None
+        while True:
+            for table in TABLES:
+                cluster_incremental(table)
+            if interval is None:
+                break
+            time.sleep(interval)
+    else:
+        cluster()
 
 
 if __name__ == '__main__':
-    cluster()
+    main()
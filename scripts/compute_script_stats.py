@@ -1,61 +1,130 @@
+from bs4.builder import HTMLTreeBuilder, LXMLTreeBuilder
+from bs4.formatter import HTMLFormatter
 from collections import defaultdict
+from body_store import load_body
 from urllib.parse import urljoin
-from bs4 import BeautifulSoup
+from sites import registered_domain
+from lxml import etree
 
-import tldextract
-import os.path
 import json
-import gzip
+import re
 
-DATA_DIRECTORY = '/data'
+# The tag tree is stored for the <html> element and four levels below it
+MAX_TREE_DEPTH = 4
 
+# BeautifulSoup details that str(soup.find("title")) depends on
+FORMATTER = HTMLFormatter.REGISTRY['minimal']
+LIST_ATTRIBUTES = HTMLTreeBuilder.DEFAULT_CDATA_LIST_ATTRIBUTES
+ASCII_SPACES = '\x20\x0a\x09\x0c\x0d'
+NON_WHITESPACE = re.compile(r'\S+')
 
-def get_sub_tree_stats(element, depth=0):
-    if element is None:
-        return None
-    if depth > 4:
-        return None
-    # [('body', [('h1', None), ('div', [...]))]
-    if len(list(element.children)) == 0:
-        return None
-    children = list()
-    for child in element.children:
-        if child.name is not None:
-            children.append((child.name, get_sub_tree_stats(child, depth + 1)))
-    if len(children) == 0:
+
+def format_title(attributes, text):
+    # Serializes the title exactly like BeautifulSoup does, <title> only ever contains text
+    tag = '<title'
+    for key, value in sorted(attributes.items()):
+        if value is None:
+            tag += f' {key}'
+            continue
+        if key in LIST_ATTRIBUTES.get('*', []) + LIST_ATTRIBUTES.get('title', []):
+            value = ' '.join(NON_WHITESPACE.findall(value))
+        tag += f' {key}={FORMATTER.quoted_attribute_value(FORMATTER.attribute_value(value))}'
+    if text and text.strip(ASCII_SPACES) == '':
+        text = '\n' if '\n' in text else ' '
+    return f'{tag}>{FORMATTER.substitute(text)}</title>'
+
+
+class HtmlFeatures:
+    """lxml parser target that collects script sources, the tag tree and the title in a single pass.
+
+    BeautifulSoup builds its tree from exactly these parser events, so the results match the previous
+    BeautifulSoup based implementation without materializing a tree.
+    """
+
+    def __init__(self, url):
+        self.url = url
+        self.scripts = defaultdict(int)
+        self.title = None
+        self.title_attributes = None
+        self.title_text = None
+        self.tree = None
+        # [name, depth relative to <html> or None, children of tracked elements]
+        self.stack = list()
+
+    def start(self, tag, attrib):
+        if tag == 'script':
+            src = attrib.get('src')
+            if src:
+                self.scripts[registered_domain(urljoin(self.url, src))] += 1
+            else:
+                self.scripts['inline'] += 1
+        elif tag == 'title' and self.title_text is None:
+            self.title_attributes = dict(attrib)
+            self.title_text = ''
+
+        parent = self.stack[-1] if self.stack else None
+        if parent is not None and parent[2] is not None:
+            depth = parent[1] + 1
+            # Below the depth limit only the name of an element is kept
+            children = list() if depth <= MAX_TREE_DEPTH else None
+            parent[2].append((tag, children))
+        elif tag == 'html' and self.tree is None:
+            depth = 0
+            children = self.tree = list()
+        else:
+            depth, children = None, None
+        self.stack.append([tag, depth, children])
+
+    def end(self, tag):
+        # Pops up to the most recent open element of that name, unmatched end tags are ignored
+        for i in range(len(self.stack) - 1, -1, -1):
+            if self.stack[i][0] == tag:
+                del self.stack[i:]
+                break
+        if tag == 'title' and self.title is None and self.title_text is not None:
+            self.title = format_title(self.title_attributes, self.title_text)
+
+    def data(self, data):
+        if self.title is None and self.title_text is not None:
+            self.title_text += data
+
+    def close(self):
+        # An unclosed title still belongs to the document
+        if self.title is None and self.title_text is not None:
+            self.title = format_title(self.title_attributes, self.title_text)
+        return self
+
+
+def to_sub_tree_stats(children):
+    # [('body', [('h1', None), ('div', [...]))], elements without child elements are None
+    if not children:
         return None
-    return children
+    return [(name, to_sub_tree_stats(sub_children)) for name, sub_children in children]
 
 
-def recursive_stats(filename):
-    file_path = f"{DATA_DIRECTORY}/{filename[0]}/{filename[1]}/{filename}.html.gz"
-    if not os.path.exists(file_path):
-        raise Exception(f"File {filename} not found")
-    soup = BeautifulSoup(gzip.open(file_path, 'r').read(), features="lxml")
-    stats = get_sub_tree_stats(soup.find("html"))
-    title = str(soup.find("title"))
-    return stats, title
+def extract_features(raw_data, url):
+    # Try the same encodings in the same order as BeautifulSoup(raw_data, features="lxml")
+    for markup, encoding, _, _ in LXMLTreeBuilder().prepare_markup(raw_data):
+        features = HtmlFeatures(url)
+        try:
+            parser = etree.HTMLParser(target=features, recover=True, encoding=encoding)
+            parser.feed(markup)
+            parser.close()
+        except (UnicodeDecodeError, LookupError, etree.ParserError):
+            continue
+        return features
+    raise Exception("The markup was rejected by the parser")
 
 
 def get_stats(filename, url):
-    file_path = f"{DATA_DIRECTORY}/{filename[0]}/{filename[1]}/{filename}.html.gz"
-    if not os.path.exists(file_path):
-        raise Exception(f"File {filename} not found")
-    raw_data = gzip.open(file_path, 'r').read()
-    soup = BeautifulSoup(raw_data, features="lxml")
-    script_stats = defaultdict(int)
-    for script in soup.find_all("script"):
-        if script.get("src"):
-            script_stats[tldextract.extract(urljoin(url, script.get("src"))).registered_domain] += 1
-        else:
-            script_stats["inline"] += 1
-    return len(raw_data), script_stats
+    raw_data = load_body(filename)
+    features = extract_features(raw_data, url)
+    return len(raw_data), features.scripts, to_sub_tree_stats(features.tree), str(features.title)
 
 
 def file_worker(relevant_part_of_file):
     try:
-        file_bytes, stats = get_stats(relevant_part_of_file, 'https://fakedomain.com')
-        html_stats, title = recursive_stats(relevant_part_of_file)
+        file_bytes, stats, html_stats, title = get_stats(relevant_part_of_file, 'https://fakedomain.com')
         return relevant_part_of_file, json.dumps(dict(stats)), json.dumps(html_stats), title, file_bytes
     except Exception as e:
         print(relevant_part_of_file)
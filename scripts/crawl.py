@@ -1,18 +1,28 @@
-from data import UserAgents, ClientConfigurations, get_db_cursor, get_scoped_db_cursor
-from compute_script_stats import file_worker
+from data import UserAgents, ClientConfigurations, get_db_cursor, get_scoped_db_cursor, get_streaming_cursor, copy_rows
+from concurrent.futures import ThreadPoolExecutor
+from classification_cache import ClassificationCache, CLASSIFIED_HEADERS, get_header_fingerprint
+from stats_pipeline import StatsPipeline, store_script_stats
 from get_https_domains import DOMAINS_FILE
 from requests import RequestException
+from scheduler import PolitenessScheduler
+from async_crawl import AsyncCrawler
+from result_sink import ResultSink
+from doCrawl import PooledCrawler
 from collections import defaultdict
-from multiprocessing import Process
+from psycopg2.extras import execute_values
+from multiprocessing import Process, Pool
 from parsers import parse_header
 from json import JSONDecodeError
+from datetime import datetime
 
 import requests.packages.urllib3.util.connection as urllib3_cn
-import tldextract
 import subprocess
+import functools
 import requests
+import asyncio
 import socket
 import random
+import sites
 import time
 import json
 import sys
@@ -48,6 +58,12 @@ PROXY_LIST = list()
 KILL = 30
 HARD_KILL = 40
 
+# Fetch engine: 'pooled' reuses one killable crawl child per worker, 'subprocess' spawns doCrawl.py per request
+FETCH_ENGINE = os.environ.get('FETCH_ENGINE', 'pooled')
+if FETCH_ENGINE not in ['pooled', 'subprocess']:
+    print('FETCH_ENGINE has to be one of [pooled|subprocess]! Abort.')
+    exit(-1)
+
 # URL range
 URL_LOWER = 0
 CHUNKSIZE = 5000
@@ -62,6 +78,36 @@ else:
         print('NUM_DOMAINS is not an integer! Abort.')
         exit(-1)
 
+# asyncio crawl mode: one event loop per worker process with many fetches in flight
+ASYNC_CRAWL = os.environ.get('ASYNC_CRAWL', '0') == '1'
+try:
+    # Upper bound for in-flight requests per worker process
+    ASYNC_CONCURRENCY = int(os.environ.get('ASYNC_CONCURRENCY', 200))
+    # Number of URLs a worker holds at once, each one is crawled politely but concurrently to the others. Only one
+    # request per site is in flight and the window is refilled once half of it is done, so by default it holds twice
+    # as many URLs as requests may be in flight.
+    ASYNC_WINDOW = int(os.environ.get('ASYNC_WINDOW', 2 * ASYNC_CONCURRENCY))
+except ValueError:
+    print('ASYNC_CONCURRENCY and ASYNC_WINDOW have to be integers! Abort.')
+    exit(-1)
+if ASYNC_WINDOW < ASYNC_CONCURRENCY:
+    print('ASYNC_WINDOW must not be smaller than ASYNC_CONCURRENCY, the concurrency could never be reached! Abort.')
+    exit(-1)
+
+# Number of URLs a synchronous worker holds at once, their requests are interleaved by the politeness scheduler
+try:
+    SCHEDULER_WINDOW = int(os.environ.get('SCHEDULER_WINDOW', 16))
+except ValueError:
+    print('SCHEDULER_WINDOW is not an integer! Abort.')
+    exit(-1)
+
+# Seconds a claimed test stays reserved for its worker, leases are renewed while the worker is alive
+try:
+    LEASE_SECONDS = int(os.environ.get('LEASE_SECONDS', 900))
+except ValueError:
+    print('LEASE_SECONDS is not an integer! Abort.')
+    exit(-1)
+
 VPN_DIR = os.path.join(os.getcwd(), 'VPN/')
 
 MATTERMOST_ERROR_HOOK = os.environ.get('MATTERMOST_ERROR_HOOK', None)
@@ -102,7 +148,22 @@ def get_vpn_list():
     return server_list
 
 
+CRAWLER = None
+CRAWLER_PID = None
+
+
+def get_crawler():
+    global CRAWLER, CRAWLER_PID
+    # Every worker process needs its own crawl child, so never reuse one inherited through fork
+    if CRAWLER is None or CRAWLER_PID != os.getpid():
+        CRAWLER = PooledCrawler(KILL, HARD_KILL)
+        CRAWLER_PID = os.getpid()
+    return CRAWLER
+
+
 def crawl(url, proxies=None, headers=None, user_agent=UserAgents['chrome']['windows']):
+    if FETCH_ENGINE == 'pooled':
+        return get_crawler().crawl(url, proxies=proxies, headers=headers, user_agent=user_agent)
     call = ['timeout', f'--kill-after={HARD_KILL}', f'{KILL}', 'python3', 'doCrawl.py']
     if proxies is not None:
         call.append(f'--proxies="{json.dumps(proxies)}"')
@@ -123,7 +184,7 @@ def classify_worker(argv):
     results = dict()
     cookies = dict()
     origin = '/'.join(end_url.split('#')[0].split('?')[0].split('/')[:3])
-    for h in ['x-frame-options', 'strict-transport-security', 'content-security-policy', 'set-cookie']:
+    for h in CLASSIFIED_HEADERS:
         value = headers.get(h, None)
         parsed = parse_header(h, value, origin)
         if h == 'set-cookie':
@@ -133,72 +194,290 @@ def classify_worker(argv):
     return row_id, results, cookies, table
 
 
+def store_result(sink, cur, table, extra, test_id, url, crawl_try, data):
+    end_url, peer, tls_version, file_name_hash, headers = data
+    # Rows are inserted in bulk later on, so the fetch time is taken here instead of the DEFAULT of the column
+    fetched = datetime.now()
+    end_origin = end_url.split("/")[0] + "//" + end_url.split("/")[2]
+    end_site = sites.registered_domain(end_url)
+    save_file_info(cur, file_name_hash)
+    parsed_headers = json.loads(headers)
+    results, cookies = classification_cache.get(get_header_fingerprint(end_url, parsed_headers),
+                                                lambda: classify_worker((1, end_url, parsed_headers, table))[1:3])
+    # Mode specific columns (onion: end_node, vpn: ip) directly follow the test column
+    columns = ['test'] + list(extra.keys()) + ['domain', 'start_url', 'end_url', 'peer', 'tls_version',
+                                               'file_name_hash', 'crawl_try', 'headers', 'end_origin', 'results',
+                                               'cookies', 'end_site', 'timestamp']
+    values = [test_id] + list(extra.values()) + [sites.domain(url), url, end_url, peer, tls_version,
+                                                 file_name_hash, crawl_try, headers, end_origin,
+                                                 json.dumps(results), json.dumps(cookies), end_site, fetched]
+    sink.add(table, columns, values)
+
+
+# -----------------------------------------------------------------------------
+# TEST CLAIMS
+# Tests are leased instead of locked: a claim marks a batch of tests with the worker and an expiry time and commits
+# immediately. Tests of crashed workers become claimable again once their lease expired.
+def prepare_test_leases(cur):
+    for table in ['browser', 'client', 'onion', 'vpn']:
+        cur.execute(f"ALTER TABLE {table}_tests ADD COLUMN IF NOT EXISTS claimed_by VARCHAR(64) DEFAULT NULL, "
+                    f"ADD COLUMN IF NOT EXISTS lease_until TIMESTAMP DEFAULT NULL;")
+        # Claims only ever look at tests that are not crawled yet
+        cur.execute(f"CREATE INDEX IF NOT EXISTS {table}_tests_open_idx ON {table}_tests (id) WHERE NOT crawled;")
+
+
+def get_worker_name():
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def lease_tests(cur, table, worker, columns, condition, params, limit, per_url):
+    lease = f"NOW() + INTERVAL '{LEASE_SECONDS} seconds'"
+    # The locked rows are picked exactly once in a CTE, an IN (...) subquery may be evaluated again by the planner
+    claimable = f"SELECT id, url FROM {table}_tests WHERE NOT crawled " \
+                f"AND (lease_until IS NULL OR lease_until < NOW()) AND {condition} " \
+                f"LIMIT {limit} FOR UPDATE SKIP LOCKED"
+    if per_url:
+        # All tests of a URL are crawled interleaved, so they are leased together: the condition selects one test per
+        # URL, whose lock stands for the URL, and the other tests of the locked URLs are locked along with it
+        claimed = f"WITH urls AS ({claimable}), c AS (SELECT id FROM {table}_tests " \
+                  f"WHERE NOT crawled AND url IN (SELECT url FROM urls) FOR UPDATE) "
+    else:
+        claimed = f"WITH c AS ({claimable}) "
+    cur.execute(claimed + f"UPDATE {table}_tests AS t SET claimed_by=%s, lease_until={lease} "
+                          f"FROM c WHERE t.id = c.id RETURNING t.id, t.url, {columns};", params + (worker,))
+    return cur.fetchall()
+
+
+def renew_test_leases(cur, table, worker):
+    cur.execute(f"UPDATE {table}_tests SET lease_until=NOW() + INTERVAL '{LEASE_SECONDS} seconds' "
+                f"WHERE claimed_by=%s AND NOT crawled;", (worker,))
+
+
+# Each claim returns a list of (url, tests) with tests being (test_id, crawl kwargs, description).
+def claim_browser_tests(cur, worker, start, end, test_count, limit=1):
+    rows = lease_tests(cur, 'browser', worker, 'browser, os',
+                       f"id > {start * test_count} AND id <= {end * test_count} AND (id %% {test_count})=0",
+                       tuple(), limit, True)
+    groups = defaultdict(list)
+    for test_id, url, browser, system in rows:
+        groups[url].append((test_id, {'user_agent': UserAgents[browser][system]}, f'{browser} on {system}'))
+    return list(groups.items())
+
+
+def claim_client_tests(cur, worker, start, end, test_count, limit=1):
+    rows = lease_tests(cur, 'client', worker, 'config',
+                       f"id > {start * test_count} AND id <= {end * test_count} AND (id %% {test_count})=0",
+                       tuple(), limit, True)
+    groups = defaultdict(list)
+    for test_id, url, config in rows:
+        groups[url].append((test_id, {'headers': config}, f'config {config}'))
+    return list(groups.items())
+
+
+def claim_onion_tests(cur, worker, end_node_data, start, end, test_count, limit=1):
+    country_code, country, _ = end_node_data
+    if country_code is None:
+        condition = f"id > {start * test_count} AND id <= {end * test_count} " \
+                    f"AND country_code IS %s AND country IS %s"
+    else:
+        condition = f"id > {start * test_count} AND id <= {end * test_count} " \
+                    f"AND country_code=%s AND country=%s"
+    rows = lease_tests(cur, 'onion', worker, 'country', condition, (country_code, country), limit, False)
+    proxies = TOR_PROXY if country is not None else None
+    return [(url, [(test_id, {'proxies': proxies}, str(end_node_data))]) for test_id, url, _ in rows]
+
+
+def claim_vpn_tests(cur, worker, vpn_data, start, end, test_count, limit=1):
+    vpn_dom, _, _ = vpn_data
+    if vpn_dom is None:
+        condition = f"id > {start * test_count} AND id <= {end * test_count} " \
+                    f"AND vpn_dom IS %s AND country_code IS %s AND country IS %s"
+    else:
+        condition = f"id > {start * test_count} AND id <= {end * test_count} " \
+                    f"AND vpn_dom=%s AND country_code=%s AND country=%s"
+    rows = lease_tests(cur, 'vpn', worker, 'vpn_dom', condition, tuple(vpn_data), limit, False)
+    return [(url, [(test_id, dict(), str(vpn_data))]) for test_id, url, _ in rows]
+
+
+# -----------------------------------------------------------------------------
+# WORKERS
+class LeasedTests:
+    """The tests a worker currently holds, refilled up to `window` URLs and finished URL by URL."""
+
+    def __init__(self, name, worker_id, table, claim, window, sink):
+        self.name = name
+        self.worker_id = worker_id
+        self.table = table
+        self.claim = claim
+        self.window = window
+        self.sink = sink
+        self.worker = get_worker_name()
+        self.cur = get_db_cursor()
+        self.tests = dict()
+        self.outstanding = dict()
+        self.errors = defaultdict(dict)
+        self.exhausted = False
+        self.last_renewal = time.time()
+
+    def __len__(self):
+        return len(self.tests)
+
+    def refill_due(self):
+        # Claim again once half of the window is done, or after running dry to pick up expired leases
+        return len(self.tests) <= self.window // 2 and not (self.exhausted and self.tests)
+
+    def claim_more(self, limit):
+        return self.claim(self.cur, self.worker, limit=limit)
+
+    def refill(self, scheduler):
+        if self.refill_due():
+            limit = self.window - len(self.tests)
+            self.add(self.claim_more(limit), limit, scheduler)
+
+    def add(self, groups, limit, scheduler):
+        self.exhausted = len(groups) < limit
+        for url, tests in groups:
+            print(f'{self.name} Worker {self.worker_id} now works on {sites.domain(url)} ({url})')
+            self.tests[url] = tests
+            self.outstanding[url] = NUM_SAMPLES * len(tests)
+            site = sites.site(url)
+            for crawl_try in range(NUM_SAMPLES):
+                for test_id, kwargs, description in random.sample(tests, len(tests)):
+                    scheduler.add(site, (url, crawl_try, test_id, kwargs, description))
+
+    def done(self, url, test_id, crawl_try, error=None):
+        if error is not None:
+            self.errors[test_id][crawl_try] = error
+        self.outstanding[url] -= 1
+        if self.outstanding[url] == 0:
+            del self.outstanding[url]
+            for test_id, _, _ in self.tests.pop(url):
+                self.sink.finish(self.table, test_id, self.errors.pop(test_id, None))
+
+    def renewal_due(self):
+        return time.time() - self.last_renewal > LEASE_SECONDS / 3
+
+    def renew(self):
+        renew_test_leases(self.cur, self.table, self.worker)
+        self.last_renewal = time.time()
+
+
+def crawl_worker(name, worker_id, table, claim, extra):
+    print(f'{name} Worker {worker_id} started ...')
+    cur = get_db_cursor()
+    sink = ResultSink()
+    leases = LeasedTests(name, worker_id, table, claim, SCHEDULER_WINDOW, sink)
+    scheduler = PolitenessScheduler()
+    try:
+        leases.refill(scheduler)
+        job = scheduler.pop()
+        while job is not None:
+            site, (url, crawl_try, test_id, kwargs, description) = job
+            success, data = crawl(url, **kwargs)
+            scheduler.release(site)
+            if success:
+                debug_print(f'Results for {description} on {url}.')
+                store_result(sink, cur, table, extra, test_id, url, crawl_try, data)
+                leases.done(url, test_id, crawl_try)
+            else:
+                debug_print(f'Error with {description} on {url}.')
+                leases.done(url, test_id, crawl_try, data)
+            if leases.renewal_due():
+                leases.renew()
+            sink.maybe_flush()
+            leases.refill(scheduler)
+            job = scheduler.pop()
+    finally:
+        sink.close()
+    classification_cache.report(f'{name} Worker {worker_id}')
+    print(f'{name} Worker {worker_id} terminates!')
+
+
+async def async_crawl_job(crawler, scheduler, executor, store, leases, job):
+    site, (url, crawl_try, test_id, kwargs, description) = job
+    success, data = await crawler.crawl(url, **kwargs)
+    scheduler.release(site)
+    if success:
+        debug_print(f'Results for {description} on {url}.')
+        await asyncio.get_running_loop().run_in_executor(executor, store, test_id, url, crawl_try, data)
+        leases.done(url, test_id, crawl_try)
+    else:
+        debug_print(f'Error with {description} on {url}.')
+        leases.done(url, test_id, crawl_try, data)
+
+
+async def async_worker(name, worker_id, table, claim, extra):
+    print(f'{name} Worker {worker_id} started in async mode ...')
+    cur = get_db_cursor()
+    crawler = AsyncCrawler(ASYNC_CONCURRENCY)
+    # Parsing and inserting results is blocking, so it runs next to the event loop in its own thread
+    executor = ThreadPoolExecutor(max_workers=1)
+    sink = ResultSink()
+    store = functools.partial(store_result, sink, cur, table, extra)
+    leases = LeasedTests(name, worker_id, table, claim, ASYNC_WINDOW, sink)
+    scheduler = PolitenessScheduler()
+    tasks = set()
+    flushing = None
+    renewing = None
+    loop = asyncio.get_running_loop()
+    try:
+        # Claims and renewals share the cursor of the leases, so both only ever run in the store thread
+        limit = leases.window
+        leases.add(await loop.run_in_executor(executor, leases.claim_more, limit), limit, scheduler)
+        while len(scheduler) > 0 or tasks:
+            job = scheduler.pop(block=False)
+            if job is not None:
+                tasks.add(asyncio.create_task(async_crawl_job(crawler, scheduler, executor, store, leases, job)))
+                continue
+            # Nothing is ready: wait for the next site to become ready or for a request to finish
+            if tasks:
+                done, tasks = await asyncio.wait(tasks, timeout=scheduler.wait_time(),
+                                                 return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    task.result()
+            else:
+                await asyncio.sleep(scheduler.wait_time())
+            # Flush and renew the leases in the store thread as well, such that the event loop never waits on the
+            # database for them
+            if flushing is not None and flushing.done():
+                flushing.result()
+                flushing = None
+            if flushing is None and sink.due():
+                flushing = executor.submit(sink.flush)
+            if renewing is not None and renewing.done():
+                renewing.result()
+                renewing = None
+            if renewing is None and leases.renewal_due():
+                renewing = executor.submit(leases.renew)
+            if leases.refill_due():
+                limit = leases.window - len(leases)
+                leases.add(await loop.run_in_executor(executor, leases.claim_more, limit), limit, scheduler)
+    finally:
+        await crawler.close()
+        executor.shutdown()
+        sink.close()
+    classification_cache.report(f'{name} Worker {worker_id}')
+    print(f'{name} Worker {worker_id} terminates!')
+
+
+def run_worker(name, worker_id, table, claim, extra):
+    if ASYNC_CRAWL:
+        asyncio.run(async_worker(name, worker_id, table, claim, extra))
+    else:
+        crawl_worker(name, worker_id, table, claim, extra)
+
+
 # -----------------------------------------------------------------------------
 # BROWSER
 def worker_browsers(worker_id, start, end, test_count):
-    print(f'Browser Worker {worker_id} started ...')
-    cur = get_db_cursor(False)
-    cur2 = get_db_cursor()
-    query = f"SELECT url FROM browser_tests WHERE NOT crawled " \
-            f"AND id > {start * test_count} AND id <= {end * test_count} " \
-            f"AND (id % {test_count})=0 LIMIT 1 FOR UPDATE SKIP LOCKED;"
-    cur.execute("BEGIN;")
-    cur.execute(query)
-    res = cur.fetchone()
-    extract = tldextract.TLDExtract()
-    while res is not None:
-        url, = res
-        cur.execute("SELECT id, browser, os FROM browser_tests WHERE url=%s FOR UPDATE;", (url,))
-        tests = cur.fetchall()
-        domain = '.'.join(extract(url))
-        if domain.startswith('.'):
-            domain = domain[1:]
-        print(f'Browser Worker {worker_id} now works on {domain} ({url})')
-        errors = defaultdict(dict)
-        for crawl_try in range(NUM_SAMPLES):
-            for test_id, browser, system in random.sample(tests, len(tests)):
-                success, data = crawl(url, user_agent=UserAgents[browser][system])
-                start_previous = time.time()
-                if success:
-                    debug_print(f'Results for {browser} on {system} for {domain}.')
-                    end_url, peer, tls_version, file_name_hash, headers = data
-                    end_origin = end_url.split("/")[0] + "//" + end_url.split("/")[2]
-                    end_site = extract(end_url).registered_domain
-                    save_file_info(cur2, file_name_hash)
-                    _, results, cookies, _ = classify_worker((1, end_url, json.loads(headers), 'browser'))
-                    cur2.execute("""
-                    INSERT INTO browser (test, domain, start_url, end_url, peer, tls_version, file_name_hash, crawl_try, 
-                    headers, end_origin, results, cookies, end_site) 
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s);
-                    """, (
-                        test_id, domain, url, end_url, peer, tls_version, file_name_hash, crawl_try, headers,
-                        end_origin, json.dumps(results), json.dumps(cookies), end_site))
-                else:
-                    errors[test_id][crawl_try] = data
-                    debug_print(f'Error with {browser} on {system} for {domain}.')
-                sleeptime = max(0, (start_previous + 2) - time.time())
-                time.sleep(sleeptime)
-
-        for test_id, _, _ in tests:
-            if test_id in errors:
-                cur.execute("UPDATE browser_tests SET error=%s, crawled=TRUE WHERE id=%s;",
-                            (json.dumps(errors[test_id]), test_id))
-            else:
-                cur.execute("UPDATE browser_tests SET crawled=TRUE WHERE id=%s", (test_id,))
-        cur.execute("COMMIT;")
-        cur.execute("END;")
-        cur.execute("BEGIN;")
-        cur.execute(query)
-        res = cur.fetchone()
-    # commit last query
-    cur.execute("COMMIT;")
-    cur.execute("END;")
-    print(f'Browser Worker {worker_id} terminates!')
+    claim = functools.partial(claim_browser_tests, start=start, end=end, test_count=test_count)
+    run_worker('Browser', worker_id, 'browser', claim, dict())
 
 
 def browser_crawler(start, end):
     print('START Browser crawl.....')
     cur = get_db_cursor()
+    prepare_test_leases(cur)
     cur.execute("SELECT COUNT(*) FROM (SELECT DISTINCT browser, os FROM browser_tests) as foo;")
     test_count, = cur.fetchone()
     processes = list()
@@ -214,69 +493,14 @@ def browser_crawler(start, end):
 # -----------------------------------------------------------------------------
 # CLIENT
 def worker_client_configurations(worker_id, start, end, test_count):
-    print(f'Client Configuration Worker {worker_id}...')
-    cur = get_db_cursor(False)
-    cur2 = get_db_cursor()
-    query = f"SELECT url FROM client_tests WHERE NOT crawled " \
-            f"AND id > {start * test_count} AND id <= {end * test_count} " \
-            f"AND (id % {test_count})=0 LIMIT 1 FOR UPDATE SKIP LOCKED;"
-    cur.execute("BEGIN;")
-    cur.execute(query)
-    res = cur.fetchone()
-    extract = tldextract.TLDExtract()
-    while res is not None:
-        url, = res
-        cur.execute("SELECT id, config FROM client_tests WHERE url=%s FOR UPDATE;", (url,))
-        tests = cur.fetchall()
-        domain = '.'.join(extract(url))
-        if domain.startswith('.'):
-            domain = domain[1:]
-        print(f'Client Configuration Worker {worker_id} now works on {domain} ({url})')
-        errors = defaultdict(dict)
-        for crawl_try in range(NUM_SAMPLES):
-            for test_id, config in random.sample(tests, len(tests)):
-                success, data = crawl(url, headers=config)
-                start_previous = time.time()
-                if success:
-                    debug_print(f'Results requesting {domain} with config {config}.')
-                    end_url, peer, tls_version, file_name_hash, headers = data
-                    end_origin = end_url.split("/")[0] + "//" + end_url.split("/")[2]
-                    end_site = extract(end_url).registered_domain
-                    save_file_info(cur2, file_name_hash)
-                    _, results, cookies, _ = classify_worker((1, end_url, json.loads(headers), 'client'))
-                    cur2.execute("""
-                    INSERT INTO client (test, domain, start_url, end_url, peer, tls_version, file_name_hash, crawl_try, 
-                    headers, end_origin, results, cookies, end_site) 
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s);
-                    """, (
-                        test_id, domain, url, end_url, peer, tls_version, file_name_hash, crawl_try, headers,
-                        end_origin, json.dumps(results), json.dumps(cookies), end_site))
-                else:
-                    errors[test_id][crawl_try] = data
-                    debug_print(f'Error in requesting {domain} with config {config}.')
-                sleeptime = max(0, (start_previous + 2) - time.time())
-                time.sleep(sleeptime)
-
-        for test_id, _ in tests:
-            if test_id in errors:
-                cur.execute("UPDATE client_tests SET error=%s, crawled=TRUE WHERE id=%s;",
-                            (json.dumps(errors[test_id]), test_id))
-            else:
-                cur.execute("UPDATE client_tests SET crawled=TRUE WHERE id=%s", (test_id,))
-        cur.execute("COMMIT;")
-        cur.execute("END;")
-        cur.execute("BEGIN;")
-        cur.execute(query)
-        res = cur.fetchone()
-    # commit last query
-    cur.execute("COMMIT;")
-    cur.execute("END;")
-    print(f'Client Configuration Worker {worker_id} terminates!')
+    claim = functools.partial(claim_client_tests, start=start, end=end, test_count=test_count)
+    run_worker('Client Configuration', worker_id, 'client', claim, dict())
 
 
 def client_configuration_crawler(start, end):
     print('START Client Configuration crawl.....')
     cur = get_db_cursor()
+    prepare_test_leases(cur)
     cur.execute("SELECT COUNT(*) FROM (SELECT DISTINCT config FROM client_tests) as foo;")
     test_count, = cur.fetchone()
     processes = list()
@@ -292,64 +516,9 @@ def client_configuration_crawler(start, end):
 # -----------------------------------------------------------------------------
 # ONION
 def worker_onion(worker_id, end_node_data, start, end, test_count):
-    print(f'Onion Worker {worker_id} started for {end_node_data}...')
-    country_code, country, end_node = end_node_data
-    cur = get_db_cursor(False)
-    cur2 = get_db_cursor()
-    if country_code is None:
-        query = f"SELECT id, url FROM onion_tests WHERE NOT crawled " \
-                f"AND id > {start * test_count} AND id <= {end * test_count} " \
-                f"AND country_code IS %s AND country IS %s LIMIT 1 FOR UPDATE SKIP LOCKED;"
-    else:
-        query = f"SELECT id, url FROM onion_tests WHERE NOT crawled " \
-                f"AND id > {start * test_count} AND id <= {end * test_count} " \
-                f"AND country_code=%s AND country=%s LIMIT 1 FOR UPDATE SKIP LOCKED;"
-    cur.execute("BEGIN;")
-    cur.execute(query, (country_code, country))
-    res = cur.fetchone()
-    extract = tldextract.TLDExtract()
-    while res is not None:
-        test_id, url = res
-        domain = '.'.join(extract(url))
-        if domain.startswith('.'):
-            domain = domain[1:]
-        print(f'Onion Worker {worker_id} now works on {domain} ({url})')
-        errors = {}
-        for crawl_try in range(NUM_SAMPLES):
-            success, data = crawl(url, proxies=(TOR_PROXY if country is not None else None))
-            start_previous = time.time()
-            if success:
-                debug_print(f'Results requesting {domain} from {end_node_data}.')
-                end_url, peer, tls_version, file_name_hash, headers = data
-                end_origin = end_url.split("/")[0] + "//" + end_url.split("/")[2]
-                end_site = extract(end_url).registered_domain
-                save_file_info(cur2, file_name_hash)
-                _, results, cookies, _ = classify_worker((1, end_url, json.loads(headers), 'onion'))
-                cur2.execute("""
-                INSERT INTO onion (test, end_node, domain, start_url, end_url, peer, tls_version, file_name_hash,
-                 crawl_try, headers, end_origin, results, cookies, end_site) 
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s);
-                """, (test_id, end_node, domain, url, end_url, peer, tls_version, file_name_hash, crawl_try, headers,
-                      end_origin, json.dumps(results), json.dumps(cookies), end_site))
-            else:
-                errors[crawl_try] = data
-                debug_print(f'Error in requesting {domain} from {end_node_data}.')
-            sleeptime = max(0, (start_previous + 2) - time.time())
-            time.sleep(sleeptime)
-        if errors:
-            cur.execute("UPDATE onion_tests SET error=%s, crawled=TRUE WHERE id=%s;",
-                        (json.dumps(errors), test_id))
-        else:
-            cur.execute("UPDATE onion_tests SET crawled=TRUE WHERE id=%s", (test_id,))
-        cur.execute("COMMIT;")
-        cur.execute("END;")
-        cur.execute("BEGIN;")
-        cur.execute(query, (country_code, country))
-        res = cur.fetchone()
-    # commit last query
-    cur.execute("COMMIT;")
-    cur.execute("END;")
-    print(f'Onion Worker {worker_id} terminates!')
+    claim = functools.partial(claim_onion_tests, end_node_data=end_node_data, start=start, end=end,
+                              test_count=test_count)
+    run_worker('Onion', worker_id, 'onion', claim, {'end_node': end_node_data[2]})
 
 
 def connect_to_tor(c):
@@ -406,6 +575,7 @@ def disconnect_tor():
 def onion_crawler(start, end):
     cur = get_db_cursor()
     print('START Onion crawl.....')
+    prepare_test_leases(cur)
     own_ip = get_ip_address()
     print(f'Own Location: {json.dumps(own_ip)}')
     cur.execute("SELECT DISTINCT country_code, country FROM onion_tests ORDER BY country;")
@@ -468,68 +638,8 @@ def onion_crawler(start, end):
 # -----------------------------------------------------------------------------
 # VPN
 def worker_vpns(worker_id, vpn_data, ip, start, end, test_count):
-    print(f'VPN Worker {worker_id} started for {vpn_data} ...')
-    vpn_dom, country_code, country = vpn_data
-    cur = get_db_cursor(False)
-    cur2 = get_db_cursor()
-    if vpn_dom is None:
-        query = f"SELECT id, url FROM vpn_tests WHERE NOT crawled " \
-                f"AND id > {start * test_count} AND id <= {end * test_count} " \
-                f"AND vpn_dom IS %s AND country_code IS %s AND country IS %s LIMIT 1 FOR UPDATE SKIP LOCKED;"
-    else:
-        query = f"SELECT id, url FROM vpn_tests WHERE NOT crawled " \
-                f"AND id > {start * test_count} AND id <= {end * test_count} " \
-                f"AND vpn_dom=%s AND country_code=%s AND country=%s LIMIT 1 FOR UPDATE SKIP LOCKED;"
-    cur.execute("BEGIN;")
-    cur.execute(query, vpn_data)
-    res = cur.fetchone()
-    tld_cache_dir = f"/tmp/tldextract_cache_{worker_id}"
-    if not os.path.exists(tld_cache_dir):
-        os.makedirs(tld_cache_dir)
-    extract = tldextract.TLDExtract(cache_dir=tld_cache_dir)
-    while res is not None:
-        test_id, url = res
-        domain = '.'.join(extract(url))
-        if domain.startswith('.'):
-            domain = domain[1:]
-        print(f'VPN Worker {worker_id} now works on {domain} ({url})')
-        errors = {}
-        for crawl_try in range(NUM_SAMPLES):
-            success, data = crawl(url)
-            start_previous = time.time()
-            if success:
-                debug_print(f'Results requesting {domain} from {vpn_data}.')
-                end_url, peer, tls_version, file_name_hash, headers = data
-                end_origin = end_url.split("/")[0] + "//" + end_url.split("/")[2]
-                end_site = extract(end_url).registered_domain
-                save_file_info(cur2, file_name_hash)
-                _, results, cookies, _ = classify_worker((1, end_url, json.loads(headers), 'vpn'))
-                cur2.execute("""
-                INSERT INTO vpn (test, ip, domain, start_url, end_url, peer, tls_version, file_name_hash, crawl_try,
-                 headers, end_origin, results, cookies, end_site) 
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s);
-                """, (
-                    test_id, ip, domain, url, end_url, peer, tls_version, file_name_hash, crawl_try, headers,
-                    end_origin, json.dumps(results), json.dumps(cookies), end_site))
-            else:
-                errors[crawl_try] = data
-                debug_print(f'Error in requesting {domain} from {vpn_data}.')
-            sleeptime = max(0, (start_previous + 2) - time.time())
-            time.sleep(sleeptime)
-        if errors:
-            cur.execute("UPDATE vpn_tests SET error=%s, crawled=TRUE WHERE id=%s;",
-                        (json.dumps(errors), test_id))
-        else:
-            cur.execute("UPDATE vpn_tests SET crawled=TRUE WHERE id=%s", (test_id,))
-        cur.execute("COMMIT;")
-        cur.execute("END;")
-        cur.execute("BEGIN;")
-        cur.execute(query, vpn_data)
-        res = cur.fetchone()
-    # commit last query
-    cur.execute("COMMIT;")
-    cur.execute("END;")
-    print(f'VPN Worker {worker_id} terminates!')
+    claim = functools.partial(claim_vpn_tests, vpn_data=vpn_data, start=start, end=end, test_count=test_count)
+    run_worker('VPN', worker_id, 'vpn', claim, {'ip': ip})
 
 
 def connect_to_vpn(c):
@@ -584,6 +694,7 @@ def disconnect_vpn():
 def vpn_crawler(start, end):
     cur = get_db_cursor()
     print('START VPN crawl.....')
+    prepare_test_leases(cur)
     cur.execute("SELECT DISTINCT vpn_dom, country_code, country FROM vpn_tests ORDER BY country_code, vpn_dom;")
     vpn_data = cur.fetchall()
     for vpn_dom, country_code, country in vpn_data:
@@ -626,18 +737,17 @@ def vpn_crawler(start, end):
     print('DONE.')
 
 
-def save_file_info(cur, file_name_hash):
-    cur.execute("SELECT 1 FROM script_stats WHERE file_name_hash=%s", (file_name_hash,))
-    if cur.rowcount > 0:
-        return
+# Started by main() before any crawl worker is forked, such that the workers inherit their queues and shared table
+stats_pipeline = StatsPipeline()
+classification_cache = ClassificationCache()
 
-    result = file_worker(file_name_hash)
-    if result:
-        rel, stats, html_stats, title, file_bytes = result
-        cur.execute("""
-                    INSERT INTO script_stats VALUES (%s, %s, %s, %s, %s) ON CONFLICT (file_name_hash) DO UPDATE 
-                    SET stats=excluded.stats, html_tree=excluded.html_tree, title=excluded.title, file_bytes=excluded.file_bytes
-                """, (rel, stats, html_stats, title, file_bytes))
+
+def save_file_info(cur, file_name_hash):
+    # Parse in the background while crawling continues, inline if the crawlers are used without the pipeline
+    if stats_pipeline.running:
+        stats_pipeline.submit(file_name_hash)
+    else:
+        store_script_stats(cur, [file_name_hash])
 
 
 # -----------------------------------------------------------------------------
@@ -842,6 +952,8 @@ def setup():
 
     print('Created table vpn_tests')
 
+    prepare_test_leases(cur)
+
     print('DONE.')
 
 
@@ -853,32 +965,31 @@ def add_tests():
             urls.append(entry.split(',', 1)[1].strip())
 
     cur = get_db_cursor()
-    for url in urls:
-        site = tldextract.extract(url).registered_domain
-        cur.execute("""
-        INSERT INTO dataset (start_url, start_site) VALUES (%s, %s) ON CONFLICT DO NOTHING
-        """, (url, site))
+    # Duplicate URLs are skipped like before, so load into a staging table and resolve conflicts in one INSERT
+    cur.execute("CREATE TEMPORARY TABLE dataset_staging (start_url VARCHAR(64), start_site VARCHAR(256));")
+    copy_rows(cur, 'dataset_staging', ['start_url', 'start_site'], sites.registered_domains(urls).items())
+    cur.execute("""
+    INSERT INTO dataset (start_url, start_site) SELECT start_url, start_site FROM dataset_staging ON CONFLICT DO NOTHING
+    """)
+    cur.execute("DROP TABLE dataset_staging;")
 
     # Browser
     if os.environ.get('DO_BROWSER', None) != '1':
         print('Skipping browser crawl preparation because DO_BROWSER != 1.')
     else:
-        for url in urls:
-            for browser in UserAgents:
-                for system in UserAgents[browser]:
-                    if UserAgents[browser][system] is not None:
-                        query = f'INSERT INTO browser_tests (browser, os, url) VALUES (%s, %s, %s)'
-                        cur.execute(query, (browser, system, url))
+        configurations = [(browser, system) for browser in UserAgents for system in UserAgents[browser]
+                          if UserAgents[browser][system] is not None]
+        copy_rows(cur, 'browser_tests', ['browser', 'os', 'url'],
+                  ((browser, system, url) for url in urls for browser, system in configurations))
         print('Filled table browser_tests')
 
     # Client
     if os.environ.get('DO_LANGUAGE', None) != '1':
         print('Skipping client crawl preparation because DO_LANGUAGE != 1.')
     else:
-        for url in urls:
-            for config in ClientConfigurations:
-                query = f'INSERT INTO client_tests (config, url) VALUES (%s, %s)'
-                cur.execute(query, (json.dumps(config), url))
+        configurations = [json.dumps(config) for config in ClientConfigurations]
+        copy_rows(cur, 'client_tests', ['config', 'url'],
+                  ((config, url) for url in urls for config in configurations))
         print('Filled table client_tests')
 
     # Onion
@@ -889,10 +1000,8 @@ def add_tests():
         c = requests.get("https://onionoo.torproject.org/details?search=flag:exit").json()
         countries = set([(x['country'], x['country_name']) for x in c["relays"]])
 
-        for url in urls:
-            for country_code, country in countries:
-                query = f'INSERT INTO onion_tests (country_code, country, url) VALUES (%s, %s, %s)'
-                cur.execute(query, (country_code, country, url))
+        copy_rows(cur, 'onion_tests', ['country_code', 'country', 'url'],
+                  ((country_code, country, url) for url in urls for country_code, country in countries))
         print('Filled table onion_tests')
 
     # VPN
@@ -900,39 +1009,106 @@ def add_tests():
         print('Skipping VPN crawl preparation because DO_VPN != 1.')
     else:
         vpn_server_list = get_vpn_list()
-        for url in urls:
-            seen_countries = set()
-            for vpn_dom, country_code, country in vpn_server_list:
-                if country_code in seen_countries:
-                    continue
-                seen_countries.add(country_code)
-                query = f'INSERT INTO vpn_tests (vpn_dom, country_code, country, url) VALUES (%s, %s, %s, %s)'
-                cur.execute(query, (vpn_dom, country_code, country, url))
+        # The first server of every country is used, which is the same for every URL
+        servers = list()
+        seen_countries = set()
+        for vpn_dom, country_code, country in vpn_server_list:
+            if country_code in seen_countries:
+                continue
+            seen_countries.add(country_code)
+            servers.append((vpn_dom, country_code, country))
+        copy_rows(cur, 'vpn_tests', ['vpn_dom', 'country_code', 'country', 'url'],
+                  ((vpn_dom, country_code, country, url) for url in urls for vpn_dom, country_code, country in servers))
         print('Filled table vpn_tests')
 
     print('DONE.')
 
 
 # -----------------------------------------------------------------------------
+# RECLASSIFY
+RECLASSIFY_BATCH = 10000
+# Fingerprints are forgotten once this many are known, such that huge tables do not exhaust the memory
+RECLASSIFY_CACHE = 1000000
+
+
+def reclassify(table, start_id=None, end_id=None):
+    if table not in CRAWLERS:
+        print(f'Unknown table {table}: Use [{"|".join(CRAWLERS)}]')
+        return
+    print(f'Reclassifying {table} ...')
+    cur = get_db_cursor()
+    # fingerprint -> (results, cookies), identical headers of other rows are not classified again
+    classified = dict()
+    updated = 0
+    total = 0
+    misses = 0
+    with Pool(PROCESSES) as pool, get_streaming_cursor(f'reclassify_{table}', RECLASSIFY_BATCH) as rows:
+        rows.execute(f"""
+            SELECT id, end_url, headers, results, cookies FROM {table}
+            WHERE headers IS NOT NULL AND id >= %s AND id <= %s ORDER BY id;
+        """, (start_id or 0, end_id or 2 ** 31 - 1))
+        batch = rows.fetchmany(RECLASSIFY_BATCH)
+        while batch:
+            fingerprints = [get_header_fingerprint(end_url, headers) for _, end_url, headers, _, _ in batch]
+            if len(classified) > RECLASSIFY_CACHE:
+                classified = dict()
+            jobs = dict()
+            for fingerprint, (row_id, end_url, headers, _, _) in zip(fingerprints, batch):
+                if fingerprint not in classified and fingerprint not in jobs:
+                    jobs[fingerprint] = (row_id, end_url, headers, table)
+            total += len(batch)
+            misses += len(jobs)
+            for fingerprint, (_, results, cookies, _) in zip(jobs, pool.map(classify_worker, jobs.values(),
+                                                                            chunksize=100)):
+                # JSON round trip, such that the results compare equal to the stored JSONB values
+                classified[fingerprint] = (json.loads(json.dumps(results)), json.loads(json.dumps(cookies)))
+            changes = list()
+            for fingerprint, (row_id, _, _, old_results, old_cookies) in zip(fingerprints, batch):
+                results, cookies = classified[fingerprint]
+                if results != old_results or cookies != old_cookies:
+                    changes.append((row_id, json.dumps(results), json.dumps(cookies)))
+            if changes:
+                execute_values(cur, f"""
+                    UPDATE {table} AS t SET results=v.results::jsonb, cookies=v.cookies::jsonb
+                    FROM (VALUES %s) AS v (id, results, cookies) WHERE t.id=v.id;
+                """, changes, page_size=len(changes))
+            updated += len(changes)
+            # Resume after this batch with: crawl.py reclassify <table> <next id>
+            print(f'Reclassified {table} up to id {batch[-1][0]} ({updated} rows changed), '
+                  f'next id {batch[-1][0] + 1}')
+            batch = rows.fetchmany(RECLASSIFY_BATCH)
+    if total:
+        print(f'Classification cache hit rate {1 - misses / total:.1%} ({misses} of {total} rows classified)')
+    print('DONE.')
+
+
+# -----------------------------------------------------------------------------
+CRAWLERS = {
+    'browser': browser_crawler,
+    'client': client_configuration_crawler,
+    'onion': onion_crawler,
+    'vpn': vpn_crawler,
+}
+
+
 def main():
     if len(sys.argv) > 1 and sys.argv[1] == 'setup':
         setup()
     elif len(sys.argv) > 1 and sys.argv[1] == 'add_tests':
         add_tests()
-    elif len(sys.argv) > 1 and sys.argv[1] == 'browser':
-        for i in range(URL_LOWER, URL_UPPER, CHUNKSIZE):
-            browser_crawler(i, min(URL_UPPER, i + CHUNKSIZE))
-    elif len(sys.argv) > 1 and sys.argv[1] == 'client':
-        for i in range(URL_LOWER, URL_UPPER, CHUNKSIZE):
-            client_configuration_crawler(i, min(URL_UPPER, i + CHUNKSIZE))
-    elif len(sys.argv) > 1 and sys.argv[1] == 'onion':
-        for i in range(URL_LOWER, URL_UPPER, CHUNKSIZE):
-            onion_crawler(i, min(URL_UPPER, i + CHUNKSIZE))
-    elif len(sys.argv) > 1 and sys.argv[1] == 'vpn':
-        for i in range(URL_LOWER, URL_UPPER, CHUNKSIZE):
-            vpn_crawler(i, min(URL_UPPER, i + CHUNKSIZE))
+    elif len(sys.argv) > 1 and sys.argv[1] in CRAWLERS:
+        stats_pipeline.start()
+        classification_cache.start_shared()
+        try:
+            for i in range(URL_LOWER, URL_UPPER, CHUNKSIZE):
+                CRAWLERS[sys.argv[1]](i, min(URL_UPPER, i + CHUNKSIZE))
+        finally:
+            classification_cache.close()
+            stats_pipeline.close()
+    elif len(sys.argv) > 2 and sys.argv[1] == 'reclassify':
+        reclassify(sys.argv[2], *[int(i) for i in sys.argv[3:5]])
     else:
-        print('No mode specified: Use [setup|add_tests|browser|client|onion|vpn]')
+        print('No mode specified: Use [setup|add_tests|browser|client|onion|vpn|reclassify <table> [start_id end_id]]')
 
 
 if __name__ == '__main__':
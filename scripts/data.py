@@ -3,6 +3,7 @@ from contextlib import contextmanager
 
 import psycopg2
 import random
+import io
 import time
 import os
 
@@ -126,3 +127,48 @@ def get_scoped_db_cursor(autocommit=True, dict_cursor=False):
     finally:
         cur.close()
         conn.close()
+
+
+@contextmanager
+def get_streaming_cursor(name, itersize=2000):
+    # Server-side cursor on a connection of its own, such that the rows are streamed in batches instead of being loaded
+    # at once
+    conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PWD)
+    cur = conn.cursor(name=name)
+    cur.itersize = itersize
+    try:
+        yield cur
+    finally:
+        conn.close()
+
+
+def csv_field(value):
+    # COPY reads an unquoted empty field as NULL and a quoted one as a string, so only None stays unquoted
+    if value is None:
+        return ''
+    return '"' + str(value).replace('"', '""') + '"'
+
+
+class CsvRowStream:
+    """File-like object that renders `rows` as CSV on demand, such that COPY never needs them all in memory."""
+
+    def __init__(self, rows):
+        self.rows = iter(rows)
+        self.buffer = io.StringIO()
+
+    def read(self, size=-1):
+        for row in self.rows:
+            self.buffer.write(','.join(map(csv_field, row)) + '\n')
+            if 0 <= size <= self.buffer.tell():
+                break
+        data = self.buffer.getvalue()
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        return data
+
+    readline = read
+
+
+def copy_rows(cur, table, columns, rows):
+    # Rows keep their order, so SERIAL ids are assigned exactly as with one INSERT per row
+    cur.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", CsvRowStream(rows))
@@ -1,18 +1,33 @@
 from contextlib import contextmanager
+from body_store import store_body, get_body_store
 from data import UserAgents
-from hashlib import md5
 
 import requests.packages.urllib3.util.connection as urllib3_cn
+import multiprocessing
 import requests
 import argparse
 import signal
 import socket
-import gzip
 import json
 import os
 
 DEBUG = False
-DATA_DIRECTORY = '/data'
+
+try:
+    # Bodies are cut off after this many bytes and flagged with the body_truncated pseudo-header
+    MAX_BODY_SIZE = int(os.environ.get('MAX_BODY_SIZE', 32 * 1024 * 1024))
+except ValueError:
+    print('MAX_BODY_SIZE has to be an integer! Abort.')
+    exit(-1)
+CHUNK_SIZE = 64 * 1024
+
+# Keep connections of a crawl process open between requests instead of a new TCP/TLS handshake for every fetch
+SESSION_REUSE = os.environ.get('SESSION_REUSE', '0') == '1'
+# With SESSION_REUSE, still start every request on a new connection, e.g., if the handshake is part of the measurement
+FRESH_CONNECTION = os.environ.get('FRESH_CONNECTION', '0') == '1'
+
+# pid -> session, forked processes must not share pooled sockets
+_sessions = dict()
 
 
 def allowed_gai_family():
@@ -46,28 +61,38 @@ def timeout(seconds):
         signal.signal(signal.SIGALRM, signal.SIG_IGN)
 
 
+def get_session():
+    if os.getpid() not in _sessions:
+        _sessions[os.getpid()] = requests.Session()
+    return _sessions[os.getpid()]
+
+
 def compute_file_name_hash(content):
-    content_hash = md5(content).hexdigest()
-    # Save file to disk
-    folder = f'{DATA_DIRECTORY}/{content_hash[0]}/{content_hash[1]}'
-    os.makedirs(folder, exist_ok=True)
-    if os.path.exists(f'{folder}/{content_hash}.html.gz'):
-        return content_hash
-    with gzip.open(f'{folder}/{content_hash}.html.gz', 'wb') as fh:
-        fh.write(content)
-    return content_hash
+    # Save file to the body store, which skips bodies it already has
+    return store_body(content)
 
 
 def crawl(url, proxies=None, headers=None, user_agent=UserAgents['chrome']['windows']):
     if headers is None:
         headers = dict()
     headers['User-Agent'] = user_agent
+    if SESSION_REUSE:
+        session = get_session()
+        # Samples stay independent: no cookies of earlier requests are sent
+        session.cookies.clear()
+        if FRESH_CONNECTION:
+            session.close()
+        get = session.get
+    else:
+        get = requests.get
+    # Only a completed request clears the flag, the alarm interrupts the request before that
+    killed = True
     with timeout(25):
         try:
             if proxies is not None:
-                r = requests.get(url, headers=headers, proxies=proxies, timeout=20, stream=True)
+                r = get(url, headers=headers, proxies=proxies, timeout=20, stream=True)
             else:
-                r = requests.get(url, headers=headers, timeout=20, stream=True)
+                r = get(url, headers=headers, timeout=20, stream=True)
             killed = False
         except Exception as exp:
             return False, str(exp) if str(exp) != 'tuple index out of range' else 'TimeoutError: signal.alarm(25)'
@@ -75,6 +100,7 @@ def crawl(url, proxies=None, headers=None, user_agent=UserAgents['chrome']['wind
     if killed:
         return False, 'Hard kill due to signal timeout!'
 
+    # Has to happen before the body is read, afterwards a pooled connection is already released again
     peer = None
     tls_version = None
     try:
@@ -92,9 +118,22 @@ def crawl(url, proxies=None, headers=None, user_agent=UserAgents['chrome']['wind
             print('Socket Error:', str(exp))
         pass
 
-    fingerprint = compute_file_name_hash(r.content)
-    if fingerprint is None:
-        return False, f'ERROR: Can not create fingerprint'
+    # Hash the body while it is downloaded, it is only compressed and stored if no identical body is stored yet
+    writer = get_body_store().writer()
+    truncated = False
+    try:
+        for chunk in r.iter_content(CHUNK_SIZE):
+            if writer.size + len(chunk) > MAX_BODY_SIZE:
+                writer.write(chunk[:MAX_BODY_SIZE - writer.size])
+                truncated = True
+                break
+            writer.write(chunk)
+        fingerprint = writer.commit()
+    except Exception as exp:
+        writer.abort()
+        return False, str(exp)
+    finally:
+        r.close()
 
     if DEBUG:
         print(f'Application-Fingerprint is: {fingerprint}')
@@ -102,11 +141,89 @@ def crawl(url, proxies=None, headers=None, user_agent=UserAgents['chrome']['wind
     result_data = [r.url, peer, tls_version, fingerprint]
     response_headers = {h.lower(): r.headers[h] for h in r.headers}
     response_headers['status_code'] = r.status_code
+    if truncated:
+        response_headers['body_truncated'] = True
     result_data.append(json.dumps(response_headers))
 
     return True, result_data
 
 
+# -----------------------------------------------------------------------------
+# POOLED CRAWLER
+def pooled_crawl_child(conn):
+    # Runs in a long-lived child, such that the interpreter and its imports are reused for many URLs.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # Do not inherit the handlers of the worker, the parent stops this child with SIGTERM/SIGKILL
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    while True:
+        try:
+            job = conn.recv()
+        except (EOFError, OSError):
+            break
+        if job is None:
+            break
+        url, proxies, headers, user_agent = job
+        try:
+            success, result = crawl(url, proxies=proxies, headers=headers, user_agent=user_agent)
+        except Exception as exp:
+            success, result = False, str(exp)
+        conn.send([success, result])
+
+
+class PooledCrawler:
+    """Reusable crawl child with the same kill semantics as `timeout --kill-after=<hard_kill> <kill>`."""
+
+    def __init__(self, kill, hard_kill):
+        self.kill = kill
+        self.hard_kill = hard_kill
+        self.process = None
+        self.conn = None
+
+    def start(self):
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=pooled_crawl_child, args=(child_conn,), daemon=True)
+        self.process.start()
+        child_conn.close()
+
+    def stop(self):
+        if self.process is None:
+            return
+        # SIGTERM after `kill` seconds, SIGKILL if the child is still alive `hard_kill` seconds after the SIGTERM,
+        # like `timeout --kill-after`
+        self.process.terminate()
+        self.process.join(self.hard_kill)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.conn.close()
+        self.process = None
+        self.conn = None
+
+    def close(self):
+        if self.process is None:
+            return
+        try:
+            self.conn.send(None)
+            self.process.join(1)
+        except (OSError, ValueError):
+            pass
+        self.stop()
+
+    def crawl(self, url, proxies=None, headers=None, user_agent=UserAgents['chrome']['windows']):
+        if self.process is None or not self.process.is_alive():
+            self.stop()
+            self.start()
+        try:
+            self.conn.send((url, proxies, headers, user_agent))
+            if self.conn.poll(self.kill):
+                return self.conn.recv()
+        except (EOFError, OSError) as exp:
+            self.stop()
+            return [False, f'Crawl child died: {exp}']
+        self.stop()
+        return [False, f'Hard kill after {self.kill} seconds!']
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("url", help="The url that should be crawled!")
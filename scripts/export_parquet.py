@@ -0,0 +1,123 @@
+from analysis_tables import TABLES, feature_columns, cookie_attrs_query
+from data import get_db_cursor, get_streaming_cursor
+
+import pyarrow.parquet as pq
+import pyarrow as pa
+import shutil
+import sys
+import os
+
+PARQUET_DIRECTORY = '/data/parquet'
+# Rows per Parquet file of a dataset
+EXPORT_BATCH = 100000
+# Directory name of the rows whose partition value is NULL, as used by Hive
+NULL_PARTITION = '__HIVE_DEFAULT_PARTITION__'
+
+# PostgreSQL type oid -> Arrow type, JSON(B) columns are exported as their text representation
+ARROW_TYPES = {
+    16: pa.bool_(),
+    20: pa.int64(),
+    21: pa.int16(),
+    23: pa.int32(),
+    25: pa.string(),
+    114: pa.string(),
+    700: pa.float32(),
+    701: pa.float64(),
+    1043: pa.string(),
+    1114: pa.timestamp('us'),
+    1184: pa.timestamp('us', tz='UTC'),
+    3802: pa.string(),
+}
+JSON_TYPES = {114, 3802}
+
+
+def quote(identifier):
+    return '"' + identifier.replace('"', '""') + '"'
+
+
+class PartitionWriter:
+    """Writes rows to <target>/part-<n>.parquet, EXPORT_BATCH rows per file."""
+
+    def __init__(self, target, schema):
+        self.target = target
+        self.schema = schema
+        self.rows = list()
+        self.parts = 0
+        os.makedirs(target, exist_ok=True)
+
+    def add(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= EXPORT_BATCH:
+            self.flush()
+
+    def flush(self):
+        columns = zip(*self.rows) if self.rows else [[]] * len(self.schema)
+        table = pa.Table.from_arrays([pa.array(values, type=field.type) for values, field in zip(columns, self.schema)],
+                                     schema=self.schema)
+        pq.write_table(table, os.path.join(self.target, f'part-{self.parts:05d}.parquet'))
+        self.parts += 1
+        self.rows = list()
+
+    def close(self):
+        # An empty dataset still gets one file, such that it can be read like the others
+        if self.rows or self.parts == 0:
+            self.flush()
+
+
+def export_query(name, query, directory, partition=None):
+    # Writes the result of the query to <directory>/<name>/part-<n>.parquet. With a partition column, the rows go to
+    # Hive style directories <directory>/<name>/<partition>=<value>/part-<n>.parquet instead, and the column is only
+    # stored in the directory names.
+    cur = get_db_cursor(False)
+    cur.execute(f"SELECT * FROM ({query}) AS q LIMIT 0;")
+    columns = [(column.name, column.type_code) for column in cur.description if column.name != partition]
+    cur.connection.close()
+    schema = pa.schema([(column, ARROW_TYPES.get(type_code, pa.string())) for column, type_code in columns])
+    # JSONB is exported exactly as PostgreSQL prints it, such that analyses see the same values
+    select = [f'{quote(column)}::text AS {quote(column)}' if type_code in JSON_TYPES else quote(column)
+              for column, type_code in columns]
+    if partition is not None:
+        select.append(f'{quote(partition)}::text')
+    target = os.path.join(directory, name)
+    shutil.rmtree(target, ignore_errors=True)
+    os.makedirs(target)
+    # partition value -> writer, a single writer without a partition column
+    writers = dict()
+    with get_streaming_cursor(f"export_{name.replace('/', '_')}") as rows:
+        rows.execute(f"SELECT {', '.join(select)} FROM ({query}) AS q;")
+        batch = rows.fetchmany(EXPORT_BATCH)
+        while batch:
+            for row in batch:
+                key, row = (row[-1], row[:-1]) if partition is not None else (None, row)
+                if key not in writers:
+                    writers[key] = PartitionWriter(partition_path(target, partition, key), schema)
+                writers[key].add(row)
+            batch = rows.fetchmany(EXPORT_BATCH)
+    if not writers:
+        writers[None] = PartitionWriter(partition_path(target, partition, None), schema)
+    for writer in writers.values():
+        writer.close()
+    print(f'Exported {name} to {sum(writer.parts for writer in writers.values())} files')
+
+
+def partition_path(target, partition, key):
+    if partition is None:
+        return target
+    return os.path.join(target, f'{partition}={NULL_PARTITION if key is None else key}')
+
+
+def export(directory=PARQUET_DIRECTORY):
+    for table in TABLES:
+        # Partitioned by the day of the crawl, such that readers can skip the files of other days
+        query = f'SELECT *, "timestamp"::date AS crawl_date, {feature_columns()} FROM {table} ORDER BY id'
+        export_query(table, query, directory, 'crawl_date')
+        export_query(f'{table}_tests', f"SELECT * FROM {table}_tests ORDER BY id", directory)
+    export_query('cookie_attrs', ' UNION ALL '.join(cookie_attrs_query(table) for table in TABLES), directory,
+                 'table_name')
+    export_query('script_stats', "SELECT * FROM script_stats", directory)
+    export_query('dataset', "SELECT * FROM dataset", directory)
+
+
+if __name__ == '__main__':
+    # Usage: python3 export_parquet.py [directory]
+    export(*sys.argv[1:2])
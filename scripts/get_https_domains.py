@@ -5,9 +5,9 @@ from multiprocessing import Pool
 from urllib.parse import urlparse
 
 import requests
-import tldextract
 
 from data import UserAgents
+from sites import registered_domain
 
 PROCESSES = os.environ.get('NUM_PROCESSES', None)
 if PROCESSES is None:
@@ -63,8 +63,8 @@ def get_end_url_origin(domain):
         return None
 
     # ignore cross-site redirects
-    original_site = wrap_tldextract(domain).registered_domain
-    if wrap_tldextract(response.url).registered_domain != original_site:
+    original_site = registered_domain(domain)
+    if registered_domain(response.url) != original_site:
         return None
 
     origin = f"{parsed_url.scheme}://"
@@ -79,18 +79,6 @@ def get_end_url_origin(domain):
     return origin
 
 
-TLDEXTRACT_CACHE = dict()
-
-
-def wrap_tldextract(url):
-    global TLDEXTRACT_CACHE
-    if url in TLDEXTRACT_CACHE:
-        return TLDEXTRACT_CACHE[url]
-    result = tldextract.extract(url)
-    TLDEXTRACT_CACHE[url] = result
-    return result
-
-
 def get_final_origin(id, domain):
     end_origin = get_end_url_origin(f"https://{domain}")
     if end_origin is None:
@@ -110,7 +98,7 @@ def write_results(filename, domains, n):
         chunk_size = min(COUNT, n - len(results))
         with Pool(PROCESSES) as p:
             for id, domain in sorted(p.starmap(get_final_origin, domains[start:start + chunk_size])):
-                registrable_domain = wrap_tldextract(domain).registered_domain
+                registrable_domain = registered_domain(domain)
                 if id != -1 and domain not in seen and registrable_domain not in seen_registrable_domains:
                     seen.add(domain)
                     seen_registrable_domains.add(registrable_domain)
@@ -0,0 +1,267 @@
+from collections import defaultdict
+from itertools import groupby, combinations
+from multiprocessing import Pool
+from data import get_streaming_cursor
+from sites import registered_domain
+
+import duckdb
+import json
+
+# Rows fetched per round trip of the server-side cursor
+STREAM_BATCH = 10000
+
+CSP_KEYS = ['XSS', 'FA', 'TLS']
+MECHANISMS = ['XSS', 'FA', 'TLS', 'XFO', 'HSTS']
+
+
+# -----------------------------------------------------------------------------
+# JSONB semantics of the SQL queries in sql_table.py
+def jsonb_text(value):
+    # value->>'key', i.e., strings unquoted and everything else in the JSONB output format
+    if value is None or isinstance(value, str):
+        return value
+    return json.dumps(value, ensure_ascii=False)
+
+
+def jsonb_key(value):
+    # Equality of JSONB values, the key order of objects is irrelevant
+    return json.dumps(value, sort_keys=True)
+
+
+def jsonb_sort_key(value):
+    # Order of JSONB values, as used by array_agg(DISTINCT ...):
+    # Object > Array > Boolean > Number > String > Null, longer containers are greater, object keys in storage order
+    if value is None:
+        return 0,
+    if isinstance(value, str):
+        return 1, value.encode()
+    if isinstance(value, bool):
+        return 3, value
+    if isinstance(value, (int, float)):
+        return 2, value
+    if isinstance(value, list):
+        return (4, len(value)) + tuple(jsonb_sort_key(v) for v in value)
+    keys = sorted(value, key=lambda k: (len(k.encode()), k.encode()))
+    return (5, len(value)) + tuple(item for k in keys for item in (jsonb_sort_key(k), jsonb_sort_key(value[k])))
+
+
+def get(results, key):
+    return results.get(key) if isinstance(results, dict) else None
+
+
+def as_int(text):
+    return None if text is None else int(text)
+
+
+def hsts_age(results):
+    hsts = get(results, 'HSTS')
+    return as_int(jsonb_text(hsts[0])) if isinstance(hsts, list) and hsts else None
+
+
+# Same filters as the usage queries, on (results, cookies::text)
+USAGE_FILTERS = {
+    "XSS": lambda results, cookies: jsonb_text(get(results, 'XSS')) == '1',
+    "FA": lambda results, cookies: as_int(jsonb_text(get(results, 'FA'))) in (1, 2, 3),
+    "TLS": lambda results, cookies: jsonb_text(get(results, 'TLS')) == '1',
+    "XFO": lambda results, cookies: jsonb_text(get(results, 'XFO')) not in (None, '0'),
+    "HSTS": lambda results, cookies: hsts_age(results) in (-1, 1, 2),
+    "cookie secure": lambda results, cookies: cookies is not None and 'secure": 1' in cookies,
+    "cookie httponly": lambda results, cookies: cookies is not None and 'httponly": 1' in cookies,
+    "cookie samesite": lambda results, cookies: cookies is not None and ('samesite": 1' in cookies or
+                                                                          'samesite": 2' in cookies),
+}
+
+
+# -----------------------------------------------------------------------------
+class TableAnalysis:
+    """Usage, intra and inter inconsistencies of one table from a single pass over its rows ordered by test and cluster.
+
+    Only the rows of the current test are kept, apart from the values that the inter queries compare across tests.
+    """
+
+    def __init__(self, table, sites):
+        self.table = table
+        self.sites = sites
+        self.usage = defaultdict(set)
+        self.intra = defaultdict(set)
+        self.inter = defaultdict(set)
+        self.cookie_debug = {'intra': defaultdict(set), 'inter': defaultdict(set)}
+        self.mechanism_debug = {'intra': defaultdict(lambda: defaultdict(set)),
+                                'inter': defaultdict(lambda: defaultdict(set))}
+        self.usage_origins = defaultdict(set)
+        # (end_origin, cluster, cookie_id) -> attributes of the cookie in clusters without an intra inconsistency
+        self.cookie_values = defaultdict(dict)
+        # mechanism -> (end_origin, cluster) -> values in clusters without an intra inconsistency
+        self.mechanism_values = defaultdict(lambda: defaultdict(set))
+        # end_origin -> HSTS values in tests without an intra inconsistency
+        self.hsts_values = defaultdict(set)
+
+    def add_test(self, rows):
+        # rows: (test, cluster, end_origin, end_site, results, cookies) of one test
+        hsts = [jsonb_text(get(row[4], 'HSTS')) for row in rows]
+        by_origin = defaultdict(list)
+        for row, value in zip(rows, hsts):
+            by_origin[row[2]].append(value)
+        for end_origin, values in by_origin.items():
+            if len(values) >= 3 and len(set(values)) > 1:
+                self.intra['HSTS no cluster'].add(end_origin)
+        if len(rows) >= 3 and len(set(hsts)) == 1:
+            for row, value in zip(rows, hsts):
+                self.hsts_values[row[2]].add(value)
+
+        for cluster, cluster_rows in groupby(rows, key=lambda row: row[1]):
+            self.add_cluster(cluster, list(cluster_rows))
+
+    def add_cluster(self, cluster, rows):
+        cookie_groups = defaultdict(dict)
+        cookie_counts = defaultdict(int)
+        cookie_distinct = defaultdict(dict)
+        for _, _, end_origin, _, results, cookies in rows:
+            cookies_text = None if cookies is None else jsonb_text(cookies)
+            for mechanism, used in USAGE_FILTERS.items():
+                if used(results, cookies_text):
+                    self.usage_origins[mechanism].add(end_origin)
+            for cookie_id, attributes in (cookies or dict()).items():
+                cookie_groups[(end_origin, cookie_id)][jsonb_key(attributes)] = attributes
+                cookie_counts[cookie_id] += 1
+                cookie_distinct[cookie_id][jsonb_key(attributes)] = attributes
+
+        for (end_origin, cookie_id), values in cookie_groups.items():
+            for a, b in combinations(values.values(), 2):
+                diffs = {x: y for x, y in a.items() if x in b and b[x] != y}
+                for flag in diffs.keys():
+                    self.intra[f"cookie {flag}"].add(end_origin)
+                    self.intra["cookie"].add(end_origin)
+                    self.cookie_debug["intra"][end_origin].add((cookie_id, flag, cluster))
+
+        if cluster is None:
+            return
+
+        for cookie_id, values in cookie_distinct.items():
+            if cookie_counts[cookie_id] >= 3 and len(values) == 1:
+                [(key, attributes)] = values.items()
+                for _, _, end_origin, end_site, _, _ in rows:
+                    if end_site in self.sites:
+                        self.cookie_values[(end_origin, cluster, cookie_id)][key] = attributes
+
+        by_origin = defaultdict(dict)
+        origin_counts = defaultdict(int)
+        for _, _, end_origin, _, results, _ in rows:
+            by_origin[end_origin][jsonb_key(results)] = results
+            origin_counts[end_origin] += 1
+        for end_origin, values in by_origin.items():
+            if origin_counts[end_origin] < 3 or len(values) < 2:
+                continue
+            self.intra["any"].add(end_origin)
+            for r1, r2 in combinations(sorted(values.values(), key=jsonb_sort_key), 2):
+                for key in r1.keys():
+                    if r2.get(key) != r1.get(key):
+                        self.intra[key].add(end_origin)
+                        self.mechanism_debug["intra"][key][end_origin].add(cluster)
+                        if key in CSP_KEYS:
+                            self.intra['CSP'].add(end_origin)
+                            self.mechanism_debug["intra"]['CSP'][end_origin].add(cluster)
+
+        if len(rows) >= 3:
+            for mechanism in MECHANISMS:
+                values = [jsonb_text(get(row[4], mechanism)) for row in rows]
+                if len(set(values)) == 1:
+                    for row, value in zip(rows, values):
+                        self.mechanism_values[mechanism][(row[2], cluster)].add(value)
+
+    def finish(self):
+        for mechanism, origins in self.usage_origins.items():
+            for end_origin in origins:
+                if end_origin is None:
+                    continue
+                extracted_site = registered_domain(end_origin)
+                if extracted_site in self.sites:
+                    self.usage[mechanism].add(extracted_site)
+        self.usage['CSP'] = self.usage['XSS'] | self.usage['TLS'] | self.usage['FA']
+        self.usage['cookie'] = self.usage['cookie secure'] | self.usage['cookie httponly'] | \
+            self.usage['cookie samesite']
+
+        for (end_origin, cluster, cookie_id), values in self.cookie_values.items():
+            for a, b in combinations(values.values(), 2):
+                for flag in a.keys() & b.keys():
+                    if a[flag] != b[flag]:
+                        self.inter[f"cookie {flag}"].add(end_origin)
+                        self.inter["cookie"].add(end_origin)
+                        self.cookie_debug["inter"][end_origin].add((cookie_id, flag, cluster))
+
+        for mechanism in MECHANISMS:
+            for (end_origin, cluster), values in self.mechanism_values[mechanism].items():
+                if len(values) > 1:
+                    self.inter["any"].add(end_origin)
+                    self.inter[mechanism].add(end_origin)
+                    self.mechanism_debug["inter"][mechanism][end_origin].add(cluster)
+                    if mechanism in CSP_KEYS:
+                        self.inter['CSP'].add(end_origin)
+                        self.mechanism_debug["inter"]['CSP'][end_origin].add(cluster)
+
+        for end_origin, values in self.hsts_values.items():
+            if len(values) > 1:
+                self.inter["HSTS no cluster"].add(end_origin)
+
+
+def stream_rows(table, parquet_directory=None):
+    # (test, cluster, end_origin, end_site, results, cookies) ordered by test and cluster, NULL clusters last
+    query = "SELECT test, cluster, end_origin, end_site, results, cookies FROM {} ORDER BY test, cluster NULLS LAST;"
+    if parquet_directory is None:
+        with get_streaming_cursor(f'analyze_{table}', STREAM_BATCH) as rows:
+            rows.execute(query.format(table))
+            yield from rows
+    else:
+        # Export of export_parquet.py, JSONB columns are stored as text and the rows are partitioned by crawl date
+        connection = duckdb.connect()
+        rows = connection.execute(query.format(
+            f"read_parquet('{parquet_directory}/{table}/*/*.parquet', hive_partitioning=1)"))
+        batch = rows.fetchmany(STREAM_BATCH)
+        while batch:
+            for test, cluster, end_origin, end_site, results, cookies in batch:
+                yield test, cluster, end_origin, end_site, None if results is None else json.loads(results), \
+                    None if cookies is None else json.loads(cookies)
+            batch = rows.fetchmany(STREAM_BATCH)
+        connection.close()
+
+
+def load_sites(parquet_directory):
+    connection = duckdb.connect()
+    rows = connection.execute(f"SELECT start_site FROM read_parquet('{parquet_directory}/dataset/*.parquet');")
+    sites = set(site for site, in rows.fetchall())
+    connection.close()
+    return sites
+
+
+def analyze_table(args):
+    table, sites, parquet_directory = args
+    analysis = TableAnalysis(table, sites)
+    for _, test_rows in groupby(stream_rows(table, parquet_directory), key=lambda row: row[0]):
+        analysis.add_test(list(test_rows))
+    analysis.finish()
+    print(f'Streamed {table}')
+    return table, analysis.usage, analysis.intra, analysis.inter, analysis.cookie_debug, \
+        {kind: {key: dict(origins) for key, origins in debug.items()} for kind, debug in
+         analysis.mechanism_debug.items()}
+
+
+def analyze(tables, sites, parquet_directory=None):
+    # Same structures as the SQL queries in sql_table.main(), the tables are analyzed in parallel processes.
+    # With a parquet_directory, the export of export_parquet.py is read instead of the database.
+    data = {"inter": dict(), "intra": dict(), "usage": dict(),
+            "intra_any": defaultdict(set), "inter_any": defaultdict(set)}
+    cookie_debug = defaultdict(lambda: defaultdict(lambda: defaultdict(set)))
+    mechanism_debug = defaultdict(lambda: defaultdict(lambda: defaultdict(lambda: defaultdict(set))))
+    with Pool(len(tables)) as pool:
+        for table, usage, intra, inter, table_cookie_debug, table_mechanism_debug in \
+                pool.map(analyze_table, [(table, sites, parquet_directory) for table in tables]):
+            data["usage"][table] = usage
+            data["intra"][table] = intra
+            data["inter"][table] = inter
+            for kind in ["intra", "inter"]:
+                for key, origins in data[kind][table].items():
+                    data[f"{kind}_any"][key].update(origins)
+                cookie_debug[kind][table] = table_cookie_debug[kind]
+                for key, origins in table_mechanism_debug[kind].items():
+                    mechanism_debug[kind][table][key] = origins
+    return data, cookie_debug, mechanism_debug
@@ -1,7 +1,20 @@
 from enums import *
 
+import functools
 import re
 
+# Number of distinct (origin, normalized policy) pairs whose classification is kept per process
+CSP_CACHE_SIZE = 65536
+
+COOKIE_SEPARATOR_REGEX = re.compile(r', (?!\d)')
+NONCE_REGEX = re.compile(r"'nonce-[^']*'")
+REPORT_URI_REGEX = re.compile(r"report-uri [^; ]*")
+REPORT_TO_REGEX = re.compile(r"report-to [^; ]*")
+INLINE_RESTRICTION_REGEX = re.compile(
+    r"^('NONCE'|'nonce-[A-Za-z0-9+/\-_]+={0,2}'|'sha(256|384|512)-[A-Za-z0-9+/\-_]+={0,2}'|'strict-dynamic')$",
+    re.IGNORECASE)
+UNSAFE_INLINE_REGEX = re.compile(r"^'unsafe-inline'$", re.IGNORECASE)
+
 
 def parse_header(header: str, value: str, origin: str) -> dict:
     if header == 'content-security-policy':
@@ -40,7 +53,7 @@ def parse_cookie(cookie_string: str) -> dict:
     if cookie_string is None:
         return {}
     parsed_cookies = dict()
-    for cv in re.split(r', (?!\d)', cookie_string):
+    for cv in COOKIE_SEPARATOR_REGEX.split(cookie_string):
         spliced = cv.split(';')
         keywords = set()
         same_site = None
@@ -85,10 +98,9 @@ def parse_cookie(cookie_string: str) -> dict:
 def is_unsafe_inline_active(sources: set) -> bool:
     allow_all_inline = False
     for source in sources:
-        r = r"^('NONCE'|'nonce-[A-Za-z0-9+/\-_]+={0,2}'|'sha(256|384|512)-[A-Za-z0-9+/\-_]+={0,2}'|'strict-dynamic')$"
-        if re.search(r, source, re.IGNORECASE):
+        if INLINE_RESTRICTION_REGEX.search(source):
             return False
-        if re.match(r"^'unsafe-inline'$", source, re.IGNORECASE):
+        if UNSAFE_INLINE_REGEX.match(source):
             allow_all_inline = True
     return allow_all_inline
 
@@ -128,17 +140,23 @@ def classify_csp(origin: str, parsed_csp: dict) -> dict:
     return classes
 
 
+def normalize_csp(raw_csp: str) -> str:
+    # Normalize Random Values
+    policy_str = NONCE_REGEX.sub("'NONCE'", raw_csp)
+    policy_str = REPORT_URI_REGEX.sub('report-uri REPORT_URI;', policy_str)
+    return REPORT_TO_REGEX.sub('report-to REPORT_URI;', policy_str)
+
+
 def parse_csp(origin: str, raw_csp: str) -> dict:
     if raw_csp is None:
         return {'FA': FA.UNSAFE.value, 'XSS': XSS.UNSAFE.value, 'TLS': TLS.UNSAFE.value}
-    # Normalize Random Values
-    policy_str = raw_csp
-    nonce_regex = r"'nonce-[^']*'"
-    policy_str = re.sub(nonce_regex, "'NONCE'", policy_str)
-    report_regex = r"report-uri [^; ]*"
-    policy_str = re.sub(report_regex, 'report-uri REPORT_URI;', policy_str)
-    report_to = r"report-to [^; ]*"
-    policy_str = re.sub(report_to, 'report-to REPORT_URI;', policy_str)
+    # Once nonces and report endpoints are normalized, the same policies repeat across samples, browsers and sites
+    return dict(classify_policy(origin, normalize_csp(raw_csp)))
+
+
+@functools.lru_cache(maxsize=CSP_CACHE_SIZE)
+def classify_policy(origin: str, policy_str: str) -> tuple:
+    # Cached results are shared between calls, hence an immutable tuple of (use case, class) pairs
     # Let policy be a new policy with an empty directive set
     complete_policy = dict()
     # For each token returned by splitting list on commas
@@ -180,8 +198,8 @@ def parse_csp(origin: str, raw_csp: str) -> dict:
                 complete_policy[use_case] = max(complete_policy[use_case], csp_classes[use_case])
             else:
                 complete_policy[use_case] = csp_classes[use_case]
-    # Return policy dict
-    return complete_policy
+    # Return policy items
+    return tuple(complete_policy.items())
 
 
 # ----------------------------------------------------------------------------
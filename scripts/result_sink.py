@@ -0,0 +1,110 @@
+from psycopg2.extras import execute_values
+from collections import defaultdict
+from data import get_db_cursor
+
+import threading
+import signal
+import time
+import json
+import os
+
+try:
+    # Flush once this many result rows are buffered ...
+    SINK_ROWS = int(os.environ.get('SINK_ROWS', 500))
+    # ... or once the oldest buffered entry is this many seconds old
+    SINK_SECONDS = int(os.environ.get('SINK_SECONDS', 10))
+except ValueError:
+    print('SINK_ROWS and SINK_SECONDS have to be integers! Abort.')
+    exit(-1)
+
+
+def raise_system_exit(signum, frame):
+    # Turn SIGTERM into an exception, such that `finally` blocks get the chance to flush the sink
+    raise SystemExit(128 + signum)
+
+
+class ResultSink:
+    """Buffers result rows and finished tests of one worker and writes them in bulk.
+
+    Rows and the tests they belong to are committed in the same transaction, so a test is never marked as crawled
+    without its results and a crashed worker leaves its leased tests to be crawled again.
+    """
+
+    def __init__(self, max_rows=SINK_ROWS, max_seconds=SINK_SECONDS):
+        self.max_rows = max_rows
+        self.max_seconds = max_seconds
+        self.cur = get_db_cursor(False)
+        # (table, columns) -> rows
+        self.rows = defaultdict(list)
+        # table -> (test_id, errors)
+        self.finished = defaultdict(list)
+        self.buffered = 0
+        self.first_buffered = None
+        # The async crawl mode stores results from a worker thread and finishes tests from the event loop
+        self.lock = threading.RLock()
+        # Serializes flushes on the cursor, without blocking add and finish
+        self.flush_lock = threading.Lock()
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, raise_system_exit)
+
+    def add(self, table, columns, values):
+        with self.lock:
+            self.rows[(table, tuple(columns))].append(tuple(values))
+            self.buffered += 1
+            if self.first_buffered is None:
+                self.first_buffered = time.time()
+
+    def finish(self, table, test_id, errors=None):
+        with self.lock:
+            self.finished[table].append((test_id, None if errors is None else json.dumps(errors)))
+            if self.first_buffered is None:
+                self.first_buffered = time.time()
+
+    def due(self):
+        if self.first_buffered is None:
+            return False
+        return self.buffered >= self.max_rows or time.time() - self.first_buffered >= self.max_seconds
+
+    def maybe_flush(self):
+        if self.due():
+            self.flush()
+
+    def flush(self):
+        # Only the buffers are swapped under the lock, such that add and finish never wait on the database
+        with self.flush_lock:
+            with self.lock:
+                if self.first_buffered is None:
+                    return
+                rows, finished, buffered = self.rows, self.finished, self.buffered
+                self.rows = defaultdict(list)
+                self.finished = defaultdict(list)
+                self.buffered = 0
+                self.first_buffered = None
+            try:
+                for (table, columns), table_rows in rows.items():
+                    execute_values(self.cur, f"INSERT INTO {table} ({', '.join(columns)}) VALUES %s;", table_rows,
+                                   page_size=len(table_rows))
+                for table, tests in finished.items():
+                    execute_values(self.cur, f"""
+                        UPDATE {table}_tests AS t SET crawled=TRUE, lease_until=NULL,
+                        error=COALESCE(v.error::jsonb, t.error)
+                        FROM (VALUES %s) AS v (id, error) WHERE t.id=v.id;
+                    """, tests, page_size=len(tests))
+                self.cur.connection.commit()
+            except BaseException:
+                self.cur.connection.rollback()
+                # Keep the entries buffered in front of the ones added meanwhile, such that a later flush retries
+                with self.lock:
+                    for key, table_rows in rows.items():
+                        self.rows[key] = table_rows + self.rows[key]
+                    for table, tests in finished.items():
+                        self.finished[table] = tests + self.finished[table]
+                    self.buffered += buffered
+                    if self.first_buffered is None:
+                        self.first_buffered = time.time()
+                raise
+
+    def close(self):
+        self.flush()
+        self.cur.close()
+        self.cur.connection.close()
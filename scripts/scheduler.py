@@ -0,0 +1,67 @@
+from collections import deque
+
+import heapq
+import time
+
+# Seconds between the end of one request and the start of the next one to the same site
+POLITENESS_DELAY = 2
+
+
+class PolitenessScheduler:
+    """Hands out the next job of whichever site may be contacted again, one request per site at a time."""
+
+    def __init__(self, delay=POLITENESS_DELAY):
+        self.delay = delay
+        # site -> jobs that still have to be done, in order
+        self.jobs = dict()
+        # (next allowed time, sequence, site) for every idle site with pending jobs
+        self.heap = list()
+        self.next_allowed = dict()
+        self.in_flight = set()
+        self.sequence = 0
+        self.pending = 0
+
+    def __len__(self):
+        return self.pending
+
+    def push(self, site):
+        self.sequence += 1
+        heapq.heappush(self.heap, (self.next_allowed.get(site, 0), self.sequence, site))
+
+    def add(self, site, job):
+        if site not in self.jobs:
+            self.jobs[site] = deque()
+            if site not in self.in_flight:
+                self.push(site)
+        self.jobs[site].append(job)
+        self.pending += 1
+
+    def wait_time(self):
+        # Seconds until the next job is ready, None if no site has pending jobs
+        if not self.heap:
+            return None
+        return max(0, self.heap[0][0] - time.time())
+
+    def pop(self, block=True):
+        wait = self.wait_time()
+        if wait is None or (wait > 0 and not block):
+            return None
+        time.sleep(wait)
+        _, _, site = heapq.heappop(self.heap)
+        job = self.jobs[site].popleft()
+        if not self.jobs[site]:
+            del self.jobs[site]
+        self.pending -= 1
+        self.in_flight.add(site)
+        return site, job
+
+    def release(self, site):
+        # Has to be called once the request of a popped job is done, the gap starts now
+        self.in_flight.discard(site)
+        self.next_allowed[site] = time.time() + self.delay
+        if site in self.jobs:
+            self.push(site)
+        # Forget sites whose gap is over anyway, such that long-running workers do not accumulate them
+        if len(self.next_allowed) > 2 * (len(self.jobs) + len(self.in_flight)) + 1024:
+            now = time.time()
+            self.next_allowed = {s: t for s, t in self.next_allowed.items() if t > now}
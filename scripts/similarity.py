@@ -1,11 +1,20 @@
 from psycopg2.extensions import cursor
 from difflib import SequenceMatcher
-from data import get_db_cursor
+from collections import OrderedDict
+from data import get_streaming_cursor
+from array import array
 
-import json
+import numpy as np
 
-SIMILARITY_CACHE = dict()
-SCRIPT_STAT_CACHE = dict()
+# (file_name_hash_a, file_name_hash_b) -> score, least recently used pairs are evicted first
+SIMILARITY_CACHE = OrderedDict()
+SIMILARITY_CACHE_SIZE = 1000000
+SIMILARITY_CACHE_STATS = {'hits': 0, 'misses': 0}
+# Rows fetched per round trip while build_full_cache streams script_stats
+SCRIPT_STAT_BATCH = 10000
+
+# Pairs with any individual similarity below this value are not similar at all
+MIN_COMPONENT_SIMILARITY = 0.75
 
 
 def jaccard_similarity(set_a: set, set_b: set) -> float:
@@ -17,12 +26,8 @@ def jaccard_similarity(set_a: set, set_b: set) -> float:
 
 
 def compute_similarity_score(a: dict, b: dict) -> float:
-    global SIMILARITY_CACHE
     # Parameter Data format: {'bytes_size': bytes_size, 'script_stats': script_stats, title: 'title'}
     # Jaccard Similarity of the set of included script domains
-    cache_key = json.dumps(a) + json.dumps(b)
-    if cache_key in SIMILARITY_CACHE:
-        return SIMILARITY_CACHE[cache_key]
     script_domains_similarity = jaccard_similarity(set(a['script_stats'].keys()), set(b['script_stats'].keys()))
     # Average similarity of the number of scripts from each domain that is in both sites
     script_number_similarity = list()
@@ -42,35 +47,146 @@ def compute_similarity_score(a: dict, b: dict) -> float:
     # Longest contiguous matching subsequence (LCS) ratio of the two titles
     title_similarity = SequenceMatcher(None, a['title'], b['title']).ratio()
     # Average over the individual computed similarity scores
-    if min([script_number_similarity, script_domains_similarity, size_similarity, title_similarity]) < 0.75:
+    if min([script_number_similarity, script_domains_similarity, size_similarity, title_similarity]) < \
+            MIN_COMPONENT_SIMILARITY:
         return 0.0
     total = sum([script_number_similarity, script_domains_similarity, size_similarity, title_similarity])
-    SIMILARITY_CACHE[cache_key] = total / 4.0
-    return SIMILARITY_CACHE[cache_key]
+    return total / 4.0
+
+
+class DomainFeatures:
+    """Feature matrices of the hashes of one domain, which rule out dissimilar pairs with a few array operations.
+
+    Every component is either computed like in compute_similarity_score or replaced by an upper bound of it, the title
+    similarity by SequenceMatcher.quick_ratio over character counts. Pairs that pass still need the exact score.
+    """
+
+    def __init__(self, stats: list):
+        script_domains = dict()
+        characters = dict()
+        for entry in stats:
+            for script_domain in entry['script_stats']:
+                script_domains.setdefault(script_domain, len(script_domains))
+            for character in entry['title']:
+                characters.setdefault(character, len(characters))
+        self.sizes = np.array([entry['bytes_size'] for entry in stats], dtype=float)
+        self.script_counts = np.zeros((len(stats), len(script_domains)))
+        self.scripts_present = np.zeros((len(stats), len(script_domains)), dtype=bool)
+        self.character_counts = np.zeros((len(stats), len(characters)))
+        for i, entry in enumerate(stats):
+            for script_domain, count in entry['script_stats'].items():
+                self.script_counts[i, script_domains[script_domain]] = count
+                self.scripts_present[i, script_domains[script_domain]] = True
+            for character in entry['title']:
+                self.character_counts[i, characters[character]] += 1
+        self.num_script_domains = self.scripts_present.sum(axis=1)
+        self.title_lengths = self.character_counts.sum(axis=1)
+
+    def candidates(self, i: int, threshold: float) -> np.ndarray:
+        # Mask of the hashes whose score with hash i can reach the threshold
+        with np.errstate(divide='ignore', invalid='ignore'):
+            largest = np.maximum(self.sizes, self.sizes[i])
+            size_similarity = np.where(largest == 0, 1.0, np.minimum(self.sizes, self.sizes[i]) / largest)
+            shared = self.scripts_present & self.scripts_present[i]
+            intersection = shared.sum(axis=1)
+            union = self.num_script_domains + self.num_script_domains[i] - intersection
+            script_domains_similarity = np.where(union == 0, 1.0, intersection / union)
+            count_ratios = np.where(shared, np.minimum(self.script_counts, self.script_counts[i]) /
+                                    np.maximum(self.script_counts, self.script_counts[i]), 0.0)
+            script_number_similarity = np.where(intersection == 0, 1.0, count_ratios.sum(axis=1) / intersection)
+            title_lengths = self.title_lengths + self.title_lengths[i]
+            title_matches = np.minimum(self.character_counts, self.character_counts[i]).sum(axis=1)
+            title_bound = np.where(title_lengths == 0, 1.0, 2.0 * title_matches / title_lengths)
+        components = np.stack([script_number_similarity, script_domains_similarity, size_similarity, title_bound])
+        # The tolerance covers rounding differences to the scalar computation
+        return (components.min(axis=0) >= MIN_COMPONENT_SIMILARITY - 1e-9) & \
+               (components.sum(axis=0) / 4.0 >= threshold - 1e-9)
+
+
+class ScriptStatStore:
+    """script_stats rows in flat arrays instead of one dict per hash.
+
+    Script domains and titles are interned, and the script stats of row i are the ids and counts between offsets[i]
+    and offsets[i + 1]. Entries are only turned into dicts when they are requested.
+    """
+
+    def __init__(self):
+        self.rows = dict()
+        self.sizes = array('q')
+        self.titles = list()
+        self.offsets = array('q', [0])
+        self.script_domains = array('l')
+        self.script_counts = array('l')
+        self.domain_names = list()
+        self.domain_ids = dict()
+        self.interned_titles = dict()
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, file_name_hash):
+        return file_name_hash in self.rows
+
+    def add(self, file_name_hash: str, size: int, stats: dict, title: str):
+        self.rows[file_name_hash] = len(self.sizes)
+        self.sizes.append(size)
+        self.titles.append(self.interned_titles.setdefault(title, title))
+        for script_domain, count in stats.items():
+            domain_id = self.domain_ids.get(script_domain)
+            if domain_id is None:
+                domain_id = self.domain_ids[script_domain] = len(self.domain_names)
+                self.domain_names.append(script_domain)
+            self.script_domains.append(domain_id)
+            self.script_counts.append(count)
+        self.offsets.append(len(self.script_domains))
+
+    def get(self, file_name_hash: str) -> dict:
+        i = self.rows[file_name_hash]
+        start, end = self.offsets[i], self.offsets[i + 1]
+        script_stats = {self.domain_names[self.script_domains[j]]: self.script_counts[j] for j in range(start, end)}
+        return {'bytes_size': self.sizes[i], 'script_stats': script_stats, 'title': self.titles[i]}
+
+
+SCRIPT_STAT_CACHE = ScriptStatStore()
 
 
 def fetch_script_stats(cur: cursor, file_name_hash: str) -> dict:
-    global SCRIPT_STAT_CACHE
-    if file_name_hash in SCRIPT_STAT_CACHE:
-        return SCRIPT_STAT_CACHE[file_name_hash]
-    cur.execute('SELECT file_bytes, stats, title FROM script_stats WHERE file_name_hash=%s', (file_name_hash,))
-    [size, stats, title] = cur.fetchone()
-    SCRIPT_STAT_CACHE[file_name_hash] = dict(zip(['bytes_size', 'script_stats', 'title'], [size, stats, title]))
-    return SCRIPT_STAT_CACHE[file_name_hash]
+    if file_name_hash not in SCRIPT_STAT_CACHE:
+        cur.execute('SELECT file_bytes, stats, title FROM script_stats WHERE file_name_hash=%s', (file_name_hash,))
+        [size, stats, title] = cur.fetchone()
+        SCRIPT_STAT_CACHE.add(file_name_hash, size, stats, title)
+    return SCRIPT_STAT_CACHE.get(file_name_hash)
 
 
 def similarity(cur: cursor, file_name_hash_a: str, file_name_hash_b: str) -> float:
+    # The pair is ordered, SequenceMatcher.ratio and thereby the score can differ when the arguments are swapped
+    cache_key = (file_name_hash_a, file_name_hash_b)
+    if cache_key in SIMILARITY_CACHE:
+        SIMILARITY_CACHE.move_to_end(cache_key)
+        SIMILARITY_CACHE_STATS['hits'] += 1
+        return SIMILARITY_CACHE[cache_key]
+    SIMILARITY_CACHE_STATS['misses'] += 1
     stats_a = fetch_script_stats(cur, file_name_hash_a)
     stats_b = fetch_script_stats(cur, file_name_hash_b)
-    return compute_similarity_score(stats_a, stats_b)
+    # Rejected pairs are cached as well, they are the majority
+    SIMILARITY_CACHE[cache_key] = compute_similarity_score(stats_a, stats_b)
+    if len(SIMILARITY_CACHE) > SIMILARITY_CACHE_SIZE:
+        SIMILARITY_CACHE.popitem(last=False)
+    return SIMILARITY_CACHE[cache_key]
 
 
-def build_full_cache(table: str):
+def build_full_cache(table: str, hashes=None):
     global SCRIPT_STAT_CACHE
-    cur = get_db_cursor()
+    # Only the hashes of this table are kept, the ones of the previous table are released
+    SCRIPT_STAT_CACHE = ScriptStatStore()
     print('Building script_stats cache!')
-    cur.execute(f'SELECT file_name_hash, file_bytes, stats, title FROM script_stats '
-                f'WHERE file_name_hash in (SELECT DISTINCT file_name_hash FROM {table});')
-    for file_name_hash, size, stats, title in cur.fetchall():
-        SCRIPT_STAT_CACHE[file_name_hash] = dict(zip(['bytes_size', 'script_stats', 'title'], [size, stats, title]))
-    print(f'Loaded {len(SCRIPT_STAT_CACHE.keys())} hashes!')
+    with get_streaming_cursor(f'script_stats_{table}', SCRIPT_STAT_BATCH) as rows:
+        if hashes is None:
+            rows.execute(f'SELECT file_name_hash, file_bytes, stats, title FROM script_stats '
+                         f'WHERE file_name_hash in (SELECT DISTINCT file_name_hash FROM {table});')
+        else:
+            rows.execute('SELECT file_name_hash, file_bytes, stats, title FROM script_stats '
+                         'WHERE file_name_hash = ANY(%s);', (list(hashes),))
+        for file_name_hash, size, stats, title in rows:
+            SCRIPT_STAT_CACHE.add(file_name_hash, size, stats, title)
+    print(f'Loaded {len(SCRIPT_STAT_CACHE)} hashes!')
@@ -0,0 +1,63 @@
+from tldextract.remote import SCHEME_RE
+from functools import lru_cache
+
+import tldextract
+
+# Hostnames whose split is kept per process, least recently used hostnames are evicted first
+SITE_CACHE_SIZE = 100000
+
+# The public suffix list snapshot that ships with tldextract, such that every process resolves the same suffixes
+# without fetching the list or sharing a cache directory
+EXTRACT = tldextract.TLDExtract(cache_dir=False, suffix_list_urls=None)
+
+
+def hostname(url):
+    # The hostname exactly as tldextract determines it, the common schemes skip the regular expression
+    if url.startswith('https://'):
+        rest = url[8:]
+    elif url.startswith('http://'):
+        rest = url[7:]
+    else:
+        rest = SCHEME_RE.sub('', url)
+    return rest.partition('/')[0].partition('?')[0].partition('#')[0].split('@')[-1].partition(':')[0] \
+        .strip().rstrip('.')
+
+
+@lru_cache(maxsize=SITE_CACHE_SIZE)
+def split_hostname(host):
+    return EXTRACT(host)
+
+
+def split(url):
+    # (subdomain, domain, suffix) like tldextract.extract(url)
+    host = hostname(url)
+    if host != host.strip():
+        # Whitespace in front of a trailing dot, tldextract would strip the hostname once more
+        return EXTRACT(url)
+    return split_hostname(host)
+
+
+def registered_domain(url):
+    return split(url).registered_domain
+
+
+def registered_domains(urls):
+    # url -> registered domain in the order of first occurrence, every distinct URL is resolved once
+    return {url: registered_domain(url) for url in dict.fromkeys(urls)}
+
+
+def domain(url):
+    # The full hostname, hosts without a subdomain have no leading dot
+    result = '.'.join(split(url))
+    if result.startswith('.'):
+        result = result[1:]
+    return result
+
+
+def site(url):
+    # Politeness is per registrable domain, hosts without one (e.g. IP addresses) are their own site
+    return registered_domain(url) or domain(url)
+
+
+def cache_info():
+    return split_hostname.cache_info()
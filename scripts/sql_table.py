@@ -1,7 +1,9 @@
+from analysis_tables import materialize, MECHANISM_COLUMNS
+from inconsistency_engine import analyze, load_sites
 from data import get_db_cursor, DB_NAME
+from sites import registered_domains
 from collections import defaultdict
 
-import tldextract
 import functools
 import itertools
 import locale
@@ -13,8 +15,6 @@ DATA_DIRECTORY = '/data'
 
 locale.setlocale(locale.LC_ALL, '')
 
-extract = tldextract.TLDExtract()
-
 
 class DDEncoder(json.JSONEncoder):
     def default(self, obj):
@@ -29,199 +29,220 @@ def recursive_filter(old_data, dataset):
     new_data = defaultdict(set)
     for key, values in old_data.items():
         if isinstance(values, set) or isinstance(values, list):
-            new_data[key] = set(
-                [extract(x).registered_domain for x in values if extract(x).registered_domain in dataset])
+            new_data[key] = set(site for site in registered_domains(values).values() if site in dataset)
         else:
             new_data[key] = recursive_filter(values, dataset)
     return new_data
 
 
-def main():
-    cur = get_db_cursor()
-
-    cur.execute("""
-    SELECT start_site FROM dataset
-    """)
-
-    sites = set([x[0] for x in cur.fetchall()])
-
-    tables = ['browser', 'client', 'vpn', 'onion']
+def query_inconsistencies(cur, tables, sites):
     csp_keys = ['XSS', 'FA', 'TLS']
     mechanisms = ['XSS', 'FA', 'TLS', 'XFO', 'HSTS']
-    cookie_mech = ['cookie', 'cookie secure', 'cookie samesite', 'cookie httponly']
 
     cookie_debug = defaultdict(lambda: defaultdict(lambda: defaultdict(set)))
     mechanism_debug = defaultdict(lambda: defaultdict(lambda: defaultdict(lambda: defaultdict(set))))
 
-    if not os.path.exists(f"result_{DB_NAME}.json"):
-        data = {"inter": dict(), "intra": dict(),
-                "usage": dict(),
-                "intra_any": defaultdict(set), "inter_any": defaultdict(set)}
-
-        filters = {"XSS": "results->>'XSS' = '1'",
-                   "FA": "(results->>'FA')::int IN (1,2,3)",
-                   "TLS": "results->>'TLS' = '1'",
-                   "XFO": "results->>'XFO' != '0'",
-                   "HSTS": "(results->'HSTS'->>0)::int IN (-1, 1, 2);",
-                   "cookie secure": "cookies::text LIKE '%secure\": 1%'",
-                   "cookie httponly": "cookies::text LIKE '%httponly\": 1%'",
-                   "cookie samesite": "cookies::text LIKE '%samesite\": 1%' or cookies::text LIKE '%samesite\": 2%'",
-                   }
+    data = {"inter": dict(), "intra": dict(),
+            "usage": dict(),
+            "intra_any": defaultdict(set), "inter_any": defaultdict(set)}
 
-        for table in tables:
-            data["inter"][table] = defaultdict(set)
-            data["intra"][table] = defaultdict(set)
-            data["usage"][table] = defaultdict(set)
+    filters = {"XSS": "xss = 1",
+               "FA": "fa IN (1,2,3)",
+               "TLS": "tls = 1",
+               "XFO": "xfo != 0",
+               "HSTS": "hsts_age IN (-1, 1, 2)",
+               "cookie secure": "cookie_secure",
+               "cookie httponly": "cookie_httponly",
+               "cookie samesite": "cookie_samesite",
+               }
 
-            for mechanism, filter_string in filters.items():
-                cur.execute(f"""
-                SELECT DISTINCT end_origin FROM {table} WHERE {filter_string}
-                """)
+    # Typed copies of the crawl tables, such that the queries below do not evaluate JSONB for every row. They are
+    # only rebuilt if their crawl table changed since the last run.
+    materialize(tables)
 
-                for end_origin, in cur.fetchall():
-                    extracted_site = extract(end_origin).registered_domain
-                    if extracted_site not in sites:
-                        continue
-                    data["usage"][table][mechanism].add(extracted_site)
-
-            data["usage"][table]['CSP'] = data["usage"][table]['XSS'] | data["usage"][table]['TLS'] | \
-                                          data["usage"][table]['FA']
-
-            data["usage"][table]['cookie'] = data["usage"][table]['cookie secure'] | \
-                                             data["usage"][table]['cookie httponly'] | \
-                                             data["usage"][table]['cookie samesite']
-
-            cur.execute(f"""
-                        SELECT end_origin, test, cluster, "key", array_agg(DISTINCT "value") as vls FROM ( 
-                        SELECT test, cluster, end_origin, (jsonb_each(cookies)).* FROM {table})
-                        as foo
-                        GROUP BY end_origin, test, cluster, "key"
-                        HAVING array_length(array_agg(DISTINCT "value"), 1) > 1;
-                        """)
-
-            for end_origin, test, cluster, cookie_id, features in cur.fetchall():
-                for a, b in itertools.combinations(features, 2):
-                    diffs = {x: y for x, y in a.items() if x in b and b[x] != y}
-                    for flag in diffs.keys():
-                        data["intra"][table][f"cookie {flag}"].add(end_origin)
-                        data["intra"][table][f"cookie"].add(end_origin)
-                        data["intra_any"][f"cookie {flag}"].add(end_origin)
-                        data["intra_any"][f"cookie"].add(end_origin)
-                        cookie_info = (cookie_id, flag, cluster)
-                        cookie_debug["intra"][table][end_origin].add(cookie_info)
+    for table in tables:
+        data["inter"][table] = defaultdict(set)
+        data["intra"][table] = defaultdict(set)
+        data["usage"][table] = defaultdict(set)
+
+        # Usage of all mechanisms per site in a single scan
+        cur.execute(f"""
+        SELECT o.site, {', '.join(f'bool_or({f})' for f in filters.values())}
+        FROM {table}_features AS f JOIN origin_sites AS o ON o.origin = f.end_origin GROUP BY o.site
+        """)
+
+        for site, *used in cur.fetchall():
+            if site not in sites:
+                continue
+            for mechanism, mechanism_used in zip(filters, used):
+                if mechanism_used:
+                    data["usage"][table][mechanism].add(site)
+
+        data["usage"][table]['CSP'] = data["usage"][table]['XSS'] | data["usage"][table]['TLS'] | \
+                                      data["usage"][table]['FA']
 
-            cur.execute(f"""
-            WITH cc AS (SELECT test, cluster, "key", count(1), array_agg(DISTINCT "value") as vls FROM ( 
-            SELECT test, cluster, (jsonb_each(cookies)).* FROM {table})
-            as foo
-            GROUP BY test, cluster, "key"
-            HAVING array_length(array_agg(DISTINCT "value"), 1) = 1
-            AND count(1) >= 3
-            )
-            
-            SELECT DISTINCT end_origin, cluster, "key", array_agg(DISTINCT "vls") FROM (
-            SELECT DISTINCT end_site, end_origin, cluster, "key", vls, test
-            FROM cc LEFT JOIN {table} USING (test, cluster)) as moo
-            WHERE end_site IN (SELECT start_site FROM dataset)
-            GROUP BY end_origin, cluster, "key" HAVING array_length(array_agg(DISTINCT vls), 1) > 1;
-            """)
+        data["usage"][table]['cookie'] = data["usage"][table]['cookie secure'] | \
+                                         data["usage"][table]['cookie httponly'] | \
+                                         data["usage"][table]['cookie samesite']
 
-            for end_origin, cluster, cookie_id, attribute_pairs in cur.fetchall():
-                for a, b in itertools.combinations(attribute_pairs, 2):
-                    a, b = a[0], b[0]
-                    for flag in a.keys() & b.keys():
-                        if a[flag] != b[flag]:
-                            data["inter"][table][f"cookie {flag}"].add(end_origin)
-                            data["inter"][table][f"cookie"].add(end_origin)
-                            data["inter_any"][f"cookie {flag}"].add(end_origin)
-                            data["inter_any"][f"cookie"].add(end_origin)
-                            cookie_info = (cookie_id, flag, cluster)
-                            cookie_debug["inter"][table][end_origin].add(cookie_info)
+        # A flag is inconsistent if it has more than one value among the cookies of a group
+        cookie_flags = ['secure', 'httponly', 'samesite']
+        differs = [f'count(DISTINCT {flag}) > 1' for flag in cookie_flags]
+        cur.execute(f"""
+                    SELECT end_origin, cluster, cookie_id, {', '.join(differs)}
+                    FROM cookie_attrs WHERE table_name = %s
+                    GROUP BY end_origin, test, cluster, cookie_id
+                    HAVING {' OR '.join(differs)};
+                    """, (table,))
+
+        for end_origin, cluster, cookie_id, *flags_differ in cur.fetchall():
+            for flag, flag_differs in zip(cookie_flags, flags_differ):
+                if flag_differs:
+                    data["intra"][table][f"cookie {flag}"].add(end_origin)
+                    data["intra"][table][f"cookie"].add(end_origin)
+                    data["intra_any"][f"cookie {flag}"].add(end_origin)
+                    data["intra_any"][f"cookie"].add(end_origin)
+                    cookie_info = (cookie_id, flag, cluster)
+                    cookie_debug["intra"][table][end_origin].add(cookie_info)
+
+        cur.execute(f"""
+        WITH cc AS (SELECT test, cluster, cookie_id, {', '.join(f'min({flag}) AS {flag}' for flag in cookie_flags)}
+        FROM cookie_attrs WHERE table_name = %s
+        GROUP BY test, cluster, cookie_id
+        HAVING count(DISTINCT ({', '.join(cookie_flags)})) = 1
+        AND count(1) >= 3
+        )
+
+        SELECT end_origin, cluster, cookie_id, {', '.join(differs)}
+        FROM cc LEFT JOIN {table}_features USING (test, cluster)
+        WHERE end_site IN (SELECT start_site FROM dataset)
+        GROUP BY end_origin, cluster, cookie_id HAVING {' OR '.join(differs)};
+        """, (table,))
+
+        for end_origin, cluster, cookie_id, *flags_differ in cur.fetchall():
+            for flag, flag_differs in zip(cookie_flags, flags_differ):
+                if flag_differs:
+                    data["inter"][table][f"cookie {flag}"].add(end_origin)
+                    data["inter"][table][f"cookie"].add(end_origin)
+                    data["inter_any"][f"cookie {flag}"].add(end_origin)
+                    data["inter_any"][f"cookie"].add(end_origin)
+                    cookie_info = (cookie_id, flag, cluster)
+                    cookie_debug["inter"][table][end_origin].add(cookie_info)
+
+        cur.execute(f"""
+        SELECT end_origin,
+        cluster,
+        test,
+        array_agg(DISTINCT results)
+        FROM {table}_features
+        WHERE cluster IS NOT NULL
+        GROUP BY 1, 2, 3
+        HAVING count(1) >= 3
+        AND array_length(array_agg(DISTINCT results), 1) > 1;
+        """)
+
+        for end_origin, cluster, test, results in cur.fetchall():
+            data["intra"][table]["any"].add(end_origin)
+            data["intra_any"]["any"].add(end_origin)
+            for r1, r2 in itertools.combinations(results, 2):
+                for key in r1.keys():
+                    if r2.get(key) != r1.get(key):
+                        data["intra"][table][key].add(end_origin)
+                        data["intra_any"][key].add(end_origin)
+                        mechanism_debug["intra"][table][key][end_origin].add(cluster)
+                        if key in csp_keys:
+                            data["intra_any"]['CSP'].add(end_origin)
+                            data["intra"][table]['CSP'].add(end_origin)
+                            mechanism_debug["intra"][table]['CSP'][end_origin].add(cluster)
+
+        cur.execute(f"""
+                    SELECT end_origin,
+                    test,
+                    array_agg(DISTINCT hsts)
+                    FROM {table}_features
+                    -- WHERE cluster IS NOT NULL
+                    GROUP BY 1, 2
+                    HAVING count(1) >= 3
+                    AND array_length(array_agg(DISTINCT hsts), 1) > 1;
+                    """)
+        for end_origin, test, results in cur.fetchall():
+            data["intra_any"]['HSTS no cluster'].add(end_origin)
+            data["intra"][table]["HSTS no cluster"].add(end_origin)
 
+        for mechanism in mechanisms:
+            column = MECHANISM_COLUMNS[mechanism]
             cur.execute(f"""
-            SELECT end_origin,
-            cluster,
-            test,
-            array_agg(DISTINCT results)
-            FROM {table} 
-            WHERE cluster IS NOT NULL
-            GROUP BY 1, 2, 3
-            HAVING count(1) >= 3
-            AND array_length(array_agg(DISTINCT results), 1) > 1;
+            SELECT
+            end_origin,
+            cluster
+            FROM (
+            SELECT test, cluster FROM {table}_features GROUP BY test, cluster HAVING count(1) >= 3 
+            AND array_length(ARRAY_AGG(DISTINCT {column}), 1) = 1
+            ) AS foo
+            LEFT JOIN {table}_features USING (test, cluster)
+            GROUP BY 1, 2
+            HAVING 
+            array_length(array_agg(DISTINCT {column}), 1) > 1;
             """)
 
-            for end_origin, cluster, test, results in cur.fetchall():
-                data["intra"][table]["any"].add(end_origin)
-                data["intra_any"]["any"].add(end_origin)
-                for r1, r2 in itertools.combinations(results, 2):
-                    for key in r1.keys():
-                        if r2.get(key) != r1.get(key):
-                            data["intra"][table][key].add(end_origin)
-                            data["intra_any"][key].add(end_origin)
-                            mechanism_debug["intra"][table][key][end_origin].add(cluster)
-                            if key in csp_keys:
-                                data["intra_any"]['CSP'].add(end_origin)
-                                data["intra"][table]['CSP'].add(end_origin)
-                                mechanism_debug["intra"][table]['CSP'][end_origin].add(cluster)
-
-            cur.execute(f"""
-                        SELECT end_origin,
-                        test,
-                        array_agg(DISTINCT results->'HSTS')
-                        FROM {table} 
-                        -- WHERE cluster IS NOT NULL
-                        GROUP BY 1, 2
-                        HAVING count(1) >= 3
-                        AND array_length(array_agg(DISTINCT results->'HSTS'), 1) > 1;
-                        """)
-            for end_origin, test, results in cur.fetchall():
-                data["intra_any"]['HSTS no cluster'].add(end_origin)
-                data["intra"][table]["HSTS no cluster"].add(end_origin)
-
-            for mechanism in mechanisms:
-                cur.execute(f"""
+            for end_origin, cluster in cur.fetchall():
+                data["inter_any"][mechanism].add(end_origin)
+                data["inter_any"]["any"].add(end_origin)
+                data["inter"][table]["any"].add(end_origin)
+                data["inter"][table][mechanism].add(end_origin)
+                mechanism_debug["inter"][table][mechanism][end_origin].add(cluster)
+                if mechanism in csp_keys:
+                    data["inter_any"]['CSP'].add(end_origin)
+                    data["inter"][table]['CSP'].add(end_origin)
+                    mechanism_debug["inter"][table]['CSP'][end_origin].add(cluster)
+
+        cur.execute(f"""
                 SELECT
-                end_origin,
-                cluster
+                DISTINCT end_origin
                 FROM (
-                SELECT test, cluster FROM {table} GROUP BY test, cluster HAVING count(1) >= 3 
-                AND array_length(ARRAY_AGG(DISTINCT results->>'{mechanism}'), 1) = 1
+                SELECT test FROM {table}_features GROUP BY test HAVING count(1) >= 3 
+                AND array_length(ARRAY_AGG(DISTINCT hsts), 1) = 1
                 ) AS foo
-                LEFT JOIN {table} USING (test, cluster)
-                GROUP BY 1, 2
+                LEFT JOIN {table}_features USING (test)
+                GROUP BY 1
                 HAVING 
-                array_length(array_agg(DISTINCT results->>'{mechanism}'), 1) > 1;
+                array_length(array_agg(DISTINCT hsts), 1) > 1;
                 """)
 
-                for end_origin, cluster in cur.fetchall():
-                    data["inter_any"][mechanism].add(end_origin)
-                    data["inter_any"]["any"].add(end_origin)
-                    data["inter"][table]["any"].add(end_origin)
-                    data["inter"][table][mechanism].add(end_origin)
-                    mechanism_debug["inter"][table][mechanism][end_origin].add(cluster)
-                    if mechanism in csp_keys:
-                        data["inter_any"]['CSP'].add(end_origin)
-                        data["inter"][table]['CSP'].add(end_origin)
-                        mechanism_debug["inter"][table]['CSP'][end_origin].add(cluster)
+        for end_origin, in cur.fetchall():
+            data["inter_any"]['HSTS no cluster'].add(end_origin)
+            # data["inter_any"]["any"].add(end_origin)
+            # data["inter"][table]["any"].add(end_origin)
+            data["inter"][table]["HSTS no cluster"].add(end_origin)
 
-            cur.execute(f"""
-                    SELECT
-                    DISTINCT end_origin
-                    FROM (
-                    SELECT test FROM {table} GROUP BY test HAVING count(1) >= 3 
-                    AND array_length(ARRAY_AGG(DISTINCT results->>'HSTS'), 1) = 1
-                    ) AS foo
-                    LEFT JOIN {table} USING (test)
-                    GROUP BY 1
-                    HAVING 
-                    array_length(array_agg(DISTINCT results->>'HSTS'), 1) > 1;
-                    """)
+    return data, cookie_debug, mechanism_debug
+
+
+def main():
+    # Usage: python3 sql_table.py [stream [parquet directory]]
+    parquet_directory = sys.argv[2] if len(sys.argv) > 2 and sys.argv[1] == 'stream' else None
+    if parquet_directory is None:
+        cur = get_db_cursor()
 
-            for end_origin, in cur.fetchall():
-                data["inter_any"]['HSTS no cluster'].add(end_origin)
-                # data["inter_any"]["any"].add(end_origin)
-                # data["inter"][table]["any"].add(end_origin)
-                data["inter"][table]["HSTS no cluster"].add(end_origin)
+        cur.execute("""
+        SELECT start_site FROM dataset
+        """)
+
+        sites = set([x[0] for x in cur.fetchall()])
+    else:
+        cur = None
+        sites = load_sites(parquet_directory)
+
+    tables = ['browser', 'client', 'vpn', 'onion']
+    mechanisms = ['XSS', 'FA', 'TLS', 'XFO', 'HSTS']
+    cookie_mech = ['cookie', 'cookie secure', 'cookie samesite', 'cookie httponly']
+
+    if not os.path.exists(f"result_{DB_NAME}.json"):
+        if len(sys.argv) > 1 and sys.argv[1] == 'stream':
+            # Every table is read once by a separate process instead of queried once per mechanism
+            data, cookie_debug, mechanism_debug = analyze(tables, sites, parquet_directory)
+        else:
+            data, cookie_debug, mechanism_debug = query_inconsistencies(cur, tables, sites)
 
         with open(f"{DATA_DIRECTORY}/result_{DB_NAME}.json", "w") as fh:
             json.dump(data, fh, cls=DDEncoder, indent=True)
@@ -246,7 +267,7 @@ def main():
         for key, values in data.items():
             if isinstance(values, set) or isinstance(values, list):
                 new_data[key] = set(values)
-                new_data[key] &= set([extract(x).registered_domain for x in other_data.get(key, [])])
+                new_data[key] &= set(registered_domains(other_data.get(key, [])).values())
             else:
                 new_data[key] = filter_with_other(values, other_data[key])
         return new_data
@@ -0,0 +1,152 @@
+from psycopg2.extras import execute_values
+from compute_script_stats import file_worker
+from multiprocessing import Process, Queue, Manager
+from data import get_db_cursor
+from queue import Empty
+
+import psycopg2
+import signal
+import time
+import os
+
+try:
+    # Number of processes that parse bodies into script_stats
+    STATS_PROCESSES = int(os.environ.get('STATS_PROCESSES', 2))
+    # Parsed bodies are inserted once this many are ready or the oldest one waited this many seconds
+    STATS_BATCH = int(os.environ.get('STATS_BATCH', 100))
+    STATS_SECONDS = int(os.environ.get('STATS_SECONDS', 5))
+except ValueError:
+    print('STATS_PROCESSES, STATS_BATCH and STATS_SECONDS have to be integers! Abort.')
+    exit(-1)
+
+# Seen-sets are reset once they hold this many hashes, the batch lookup in script_stats still catches repeats
+SEEN_LIMIT = 1000000
+# A crawl worker submits a hash again if the parsers did not report it as stored this many seconds after submitting
+RESUBMIT_SECONDS = 60
+
+
+def store_script_stats(cur, hashes):
+    # Skip bodies that are already in script_stats with a single lookup for the whole batch
+    cur.execute("SELECT file_name_hash FROM script_stats WHERE file_name_hash = ANY(%s)", (list(hashes),))
+    known = {file_name_hash for file_name_hash, in cur.fetchall()}
+    rows = list()
+    for file_name_hash in hashes:
+        if file_name_hash not in known:
+            result = file_worker(file_name_hash)
+            if result:
+                rows.append(result)
+    if rows:
+        execute_values(cur, """
+                    INSERT INTO script_stats VALUES %s ON CONFLICT (file_name_hash) DO UPDATE
+                    SET stats=excluded.stats, html_tree=excluded.html_tree, title=excluded.title, file_bytes=excluded.file_bytes
+                """, rows)
+    # Bodies that could not be parsed are not in script_stats
+    return known | {row[0] for row in rows}
+
+
+def store_batch(cur, batch, seen, reported):
+    try:
+        stored = store_script_stats(cur, batch)
+    except psycopg2.Error as exp:
+        # Not marked as seen, such that the bodies are parsed again the next time they are submitted
+        print(f'Could not store script_stats of {len(batch)} bodies: {exp}')
+        return
+    if len(seen) + len(stored) >= SEEN_LIMIT:
+        seen.clear()
+        reported.clear()
+    seen.update(stored)
+    # Tells the crawl workers which hashes they never have to submit again
+    reported.update(dict.fromkeys(stored, True))
+
+
+def stats_worker(queue, reported):
+    # The crawl process stops the pipeline on Ctrl+C, until then the queue is drained
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    cur = get_db_cursor()
+    # Hashes that are in script_stats, and those waiting for the next batch
+    seen = set()
+    batch = list()
+    queued = set()
+    first_queued = None
+    while True:
+        try:
+            file_name_hash = queue.get(timeout=1)
+        except Empty:
+            file_name_hash = ''
+        if file_name_hash is None:
+            break
+        if file_name_hash and file_name_hash not in seen and file_name_hash not in queued:
+            batch.append(file_name_hash)
+            queued.add(file_name_hash)
+            if first_queued is None:
+                first_queued = time.time()
+        if batch and (len(batch) >= STATS_BATCH or time.time() - first_queued >= STATS_SECONDS):
+            store_batch(cur, batch, seen, reported)
+            batch = list()
+            queued = set()
+            first_queued = None
+    if batch:
+        store_batch(cur, batch, seen, reported)
+
+
+class StatsPipeline:
+    """Parses newly crawled bodies into script_stats in background processes.
+
+    Crawl workers forked after `start` inherit the queues and only enqueue hashes. Every hash always goes to the same
+    parser, such that the seen-sets of the parsers do not overlap. The parsers report stored hashes in a table shared
+    through a Manager. A crawl worker skips hashes that were reported, and hashes it submitted itself until they are
+    RESUBMIT_SECONDS old, after which an unreported one is submitted again.
+    """
+
+    def __init__(self, processes=STATS_PROCESSES):
+        self.processes = processes
+        self.queues = list()
+        self.workers = list()
+        self.manager = None
+        self.reported = None
+        # Per crawl worker: hashes known to be stored, and hash -> time it was submitted
+        self.stored = set()
+        self.submitted = dict()
+
+    @property
+    def running(self):
+        return len(self.workers) > 0
+
+    def start(self):
+        self.manager = Manager()
+        self.reported = self.manager.dict()
+        for _ in range(self.processes):
+            queue = Queue()
+            worker = Process(target=stats_worker, args=(queue, self.reported))
+            worker.start()
+            self.queues.append(queue)
+            self.workers.append(worker)
+
+    def submit(self, file_name_hash):
+        if file_name_hash in self.stored:
+            return
+        now = time.time()
+        if file_name_hash in self.submitted:
+            if now - self.submitted[file_name_hash] < RESUBMIT_SECONDS:
+                return
+            if self.reported.get(file_name_hash, False):
+                del self.submitted[file_name_hash]
+                if len(self.stored) >= SEEN_LIMIT:
+                    self.stored.clear()
+                self.stored.add(file_name_hash)
+                return
+        if len(self.submitted) >= SEEN_LIMIT:
+            self.submitted.clear()
+        self.submitted[file_name_hash] = now
+        self.queues[int(file_name_hash[:8], 16) % len(self.queues)].put(file_name_hash)
+
+    def close(self):
+        for queue in self.queues:
+            queue.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.manager.shutdown()
+        self.manager = None
+        self.reported = None
+        self.queues = list()
+        self.workers = list()
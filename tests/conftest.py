@@ -0,0 +1,48 @@
+import psycopg2
+import pytest
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'scripts'))
+
+# The tests need the database of the DB_* environment variables, they run in a schema of their own inside of it
+DB_VARIABLES = ['DB_HOST', 'DB_PORT', 'DB_USER', 'DB_PWD', 'DB_NAME']
+TEST_SCHEMA = f'pytest_{os.getpid()}'
+
+if any(variable not in os.environ for variable in DB_VARIABLES):
+    collect_ignore_glob = ['test_*.py']
+else:
+    # Every connection of the scripts, also those of forked workers, only sees the tables of the test schema
+    os.environ['PGOPTIONS'] = f'-c search_path={TEST_SCHEMA}'
+
+
+def connect():
+    conn = psycopg2.connect(host=os.environ['DB_HOST'], port=os.environ['DB_PORT'], database=os.environ['DB_NAME'],
+                            user=os.environ['DB_USER'], password=os.environ['DB_PWD'])
+    conn.autocommit = True
+    return conn
+
+
+@pytest.fixture(scope='session', autouse=True)
+def test_schema():
+    try:
+        conn = connect()
+    except psycopg2.OperationalError as exp:
+        pytest.skip(f'Database not reachable: {exp}')
+    cur = conn.cursor()
+    cur.execute(f"CREATE SCHEMA {TEST_SCHEMA};")
+    yield TEST_SCHEMA
+    cur.execute(f"DROP SCHEMA {TEST_SCHEMA} CASCADE;")
+    conn.close()
+
+
+@pytest.fixture
+def cur(test_schema):
+    conn = connect()
+    cur = conn.cursor()
+    yield cur
+    # Every test starts without the tables of the previous one
+    cur.execute("SELECT tablename FROM pg_tables WHERE schemaname = %s;", (test_schema,))
+    for table, in cur.fetchall():
+        cur.execute(f'DROP TABLE "{table}" CASCADE;')
+    conn.close()
@@ -0,0 +1,46 @@
+from data import get_db_cursor
+
+import analysis_tables
+import crawl
+import time
+
+TABLES = ['browser', 'client']
+
+
+def write(cur, table, statement):
+    # Statistics are reported by the writing connection at the latest when it closes
+    old = analysis_tables.watermark(cur, table)
+    writer = get_db_cursor()
+    writer.execute(statement)
+    writer.connection.close()
+    deadline = time.time() + 10
+    while analysis_tables.watermark(cur, table) == old and time.time() < deadline:
+        time.sleep(0.1)
+
+
+def rebuilt(capsys):
+    analysis_tables.materialize(TABLES)
+    output = capsys.readouterr().out
+    return [table for table in TABLES if f'Materializing {table}_features' in output]
+
+
+def test_materialize_rebuilds_changed_tables(cur, capsys):
+    crawl.setup()
+    for table in TABLES:
+        write(cur, table, f"""INSERT INTO {table} (test, end_origin, results, cookies, cluster)
+                              VALUES (1, 'https://a.com', '{{"XSS": 1}}', '{{"sid": {{"secure": 1}}}}', 1);""")
+    assert rebuilt(capsys) == TABLES
+    assert rebuilt(capsys) == []
+
+    write(cur, 'browser', "UPDATE browser SET cluster = 2;")
+    assert rebuilt(capsys) == ['browser']
+    cur.execute("SELECT cluster FROM browser_features;")
+    assert cur.fetchall() == [(2,)]
+
+    write(cur, 'client', "TRUNCATE client;")
+    assert rebuilt(capsys) == ['client']
+
+    # Nothing is installed on the crawl tables
+    cur.execute("SELECT count(*) FROM pg_trigger WHERE tgrelid IN ('browser'::regclass, 'client'::regclass) "
+                "AND NOT tgisinternal;")
+    assert cur.fetchone() == (0,)
@@ -0,0 +1,59 @@
+import body_store
+
+
+def packs(directory):
+    return sorted(path.name for path in directory.iterdir() if path.name.endswith('.pack'))
+
+
+def test_restarted_writer_appends_to_its_pack(tmp_path):
+    store = body_store.PackStore(str(tmp_path))
+    store.put('a' * 32, b'first body')
+    store.close()
+    # A restarted crawl child opens the store again
+    store = body_store.PackStore(str(tmp_path))
+    store.put('b' * 32, b'second body')
+    # A second writer that is alive at the same time gets a pack of its own
+    other = body_store.PackStore(str(tmp_path))
+    other.put('c' * 32, b'third body')
+    assert len(packs(tmp_path)) == 2
+    assert [store.get(content_hash) for content_hash in ['a' * 32, 'b' * 32, 'c' * 32]] == [
+        b'first body', b'second body', b'third body']
+    other.close()
+    store.close()
+
+
+def test_packs_roll_by_size(tmp_path, monkeypatch):
+    monkeypatch.setattr(body_store, 'PACK_SIZE', 10)
+    store = body_store.PackStore(str(tmp_path))
+    for i in range(3):
+        store.put(str(i) * 32, b'body ' * 10)
+    store.close()
+    assert len(packs(tmp_path)) == 3
+
+
+def test_readers_bound_open_packs(tmp_path, monkeypatch):
+    monkeypatch.setattr(body_store, 'PACK_SIZE', 10)
+    monkeypatch.setattr(body_store, 'PACK_OPEN_FILES', 2)
+    store = body_store.PackStore(str(tmp_path))
+    bodies = {str(i) * 32: f'body {i}'.encode() * 10 for i in range(5)}
+    for content_hash, content in bodies.items():
+        store.put(content_hash, content)
+    for _ in range(2):
+        for content_hash, content in bodies.items():
+            assert store.get(content_hash) == content
+            assert len(store.packs) <= 2
+    store.close()
+
+
+def test_duplicate_bodies_are_compressed_once(tmp_path, monkeypatch):
+    store = body_store.GzipFileStore(str(tmp_path))
+    compressed = list()
+    gzip_open = body_store.gzip.open
+    monkeypatch.setattr(body_store.gzip, 'open', lambda path, mode: compressed.append(mode) or gzip_open(path, mode))
+    for _ in range(3):
+        writer = store.writer()
+        for chunk in [b'same ', b'body']:
+            writer.write(chunk)
+        content_hash = writer.commit()
+    assert compressed == ['wb']
+    assert store.get(content_hash) == b'same body'
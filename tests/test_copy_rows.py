@@ -0,0 +1,11 @@
+from data import copy_rows
+
+
+def test_copy_rows_round_trip(cur):
+    cur.execute("CREATE TABLE copy_test (id SERIAL PRIMARY KEY, name TEXT, count INTEGER, error JSONB);")
+    rows = [('a', 1, None), (None, None, '{"k": "v"}'), ('', 0, None), ('quote " and, comma\nnewline', 2, None)]
+    copy_rows(cur, 'copy_test', ['name', 'count', 'error'], rows)
+    cur.execute("SELECT name, count, error::text FROM copy_test ORDER BY id;")
+    assert cur.fetchall() == rows
+    cur.execute("SELECT COUNT(*) FROM copy_test WHERE name IS NULL;")
+    assert cur.fetchone() == (1,)
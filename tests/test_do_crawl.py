@@ -0,0 +1,15 @@
+import doCrawl
+
+
+class AlarmDuringError(Exception):
+    def __str__(self):
+        # The SIGALRM handler fires while the error of the request is handled
+        raise TimeoutError
+
+
+def test_crawl_reports_alarm_as_hard_kill(monkeypatch):
+    def failing(*args, **kwargs):
+        raise AlarmDuringError()
+
+    monkeypatch.setattr(doCrawl.requests, 'get', failing)
+    assert doCrawl.crawl('https://example.com/') == (False, 'Hard kill due to signal timeout!')
@@ -0,0 +1,43 @@
+from datetime import datetime
+
+import export_parquet
+import duckdb
+import os
+
+ROWS = [
+    (1, datetime(2022, 1, 5, 12, 30), '{"a": 1}', 'first'),
+    (2, datetime(2022, 1, 5, 23, 59), None, 'second'),
+    (3, datetime(2022, 1, 6, 0, 1), '[1, 2]', None),
+    (4, None, '{}', 'fourth'),
+]
+
+
+def test_export_partitions_by_crawl_date(cur, tmp_path):
+    cur.execute('CREATE TABLE export_test (id INTEGER, "timestamp" TIMESTAMP, headers JSONB, name TEXT);')
+    cur.executemany("INSERT INTO export_test VALUES (%s, %s, %s, %s);", ROWS)
+
+    export_parquet.export_query('export_test', 'SELECT *, "timestamp"::date AS crawl_date FROM export_test ORDER BY id',
+                                str(tmp_path), 'crawl_date')
+
+    assert sorted(os.listdir(tmp_path / 'export_test')) == [
+        'crawl_date=2022-01-05', 'crawl_date=2022-01-06', f'crawl_date={export_parquet.NULL_PARTITION}']
+    connection = duckdb.connect()
+    source = f"read_parquet('{tmp_path}/export_test/*/*.parquet', hive_partitioning=1)"
+    rows = connection.execute(f'SELECT id, "timestamp", headers, name FROM {source} ORDER BY id;').fetchall()
+    assert rows == [(1, ROWS[0][1], '{"a": 1}', 'first'), (2, ROWS[1][1], None, 'second'),
+                    (3, ROWS[2][1], '[1, 2]', None), (4, None, '{}', 'fourth')]
+    # The partition column is available for filters
+    day = connection.execute(f"SELECT id FROM {source} WHERE crawl_date = '2022-01-05' ORDER BY id;").fetchall()
+    assert day == [(1,), (2,)]
+    connection.close()
+
+
+def test_export_empty_query(cur, tmp_path):
+    cur.execute('CREATE TABLE export_test (id INTEGER, "timestamp" TIMESTAMP);')
+
+    export_parquet.export_query('export_test', 'SELECT * FROM export_test', str(tmp_path))
+
+    connection = duckdb.connect()
+    assert connection.execute(
+        f"SELECT count(*) FROM read_parquet('{tmp_path}/export_test/*.parquet');").fetchone() == (0,)
+    connection.close()
@@ -0,0 +1,35 @@
+from psycopg2.extras import execute_values
+
+import compute_clustering
+import crawl
+import json
+
+SCRIPT_STATS = [
+    ('alpha', {'a.com': 5}, 'Alpha page', 1000),
+    ('beta', {'b.com': 3, 'inline': 2}, 'Beta', 50000),
+    ('gamma', {'c.com': 1}, 'Something else entirely', 200000),
+    ('alpha2', {'a.com': 5}, 'Alpha page', 1000),
+]
+
+
+def test_incremental_keeps_clusters_without_members(cur):
+    # A table clustered before cluster_members existed
+    crawl.setup()
+    compute_clustering.create_cluster_members()
+    execute_values(cur, "INSERT INTO script_stats VALUES %s;",
+                   [(h, json.dumps(stats), '[]', title, size) for h, stats, title, size in SCRIPT_STATS])
+    execute_values(cur, "INSERT INTO client (test, domain, file_name_hash, cluster) VALUES %s;", [
+        (1, 'example.com', 'alpha', 1), (2, 'example.com', 'beta', 2),
+        (3, 'example.com', 'gamma', None), (4, 'example.com', 'alpha2', None),
+    ])
+
+    compute_clustering.cluster_incremental('client')
+
+    cur.execute("SELECT file_name_hash, cluster FROM client ORDER BY test;")
+    clusters = dict(cur.fetchall())
+    assert clusters['alpha'] == 1 and clusters['beta'] == 2
+    # New hashes join a similar existing cluster, or get a new id
+    assert clusters['alpha2'] == 1
+    assert clusters['gamma'] == 3
+    cur.execute("SELECT cluster, file_name_hash FROM cluster_members WHERE table_name = 'client' ORDER BY 1, 2;")
+    assert cur.fetchall() == [(1, 'alpha'), (1, 'alpha2'), (2, 'beta'), (3, 'gamma')]
@@ -0,0 +1,40 @@
+from data import get_db_cursor, copy_rows
+
+import psycopg2.errors
+import crawl
+import pytest
+
+URLS = [f'https://site{i}.example/' for i in range(5)]
+CONFIGURATIONS = [('chrome', 'windows'), ('chrome', 'linux'), ('firefox', 'linux')]
+
+
+def claim(cur, worker, limit):
+    return crawl.claim_browser_tests(cur, worker, 0, len(URLS), len(CONFIGURATIONS), limit=limit)
+
+
+def test_claims_lock_whole_urls(cur):
+    crawl.setup()
+    copy_rows(cur, 'browser_tests', ['browser', 'os', 'url'],
+              [(browser, system, url) for url in URLS for browser, system in CONFIGURATIONS])
+    first = get_db_cursor(False)
+    second = get_db_cursor(False)
+
+    # Both claims stay uncommitted, such that the locks of the first one are still held
+    claimed = claim(first, 'first', 2)
+    assert len(claimed) == 2
+    assert all(len(tests) == len(CONFIGURATIONS) for _, tests in claimed)
+    others = claim(second, 'second', 2)
+    assert len(others) == 2
+    assert not {url for url, _ in claimed} & {url for url, _ in others}
+    second.connection.rollback()
+
+    # Every test of a claimed URL is locked, not only the one the claim picked the URL by
+    with pytest.raises(psycopg2.errors.LockNotAvailable):
+        second.execute("SELECT id FROM browser_tests WHERE url = %s FOR UPDATE NOWAIT;", (claimed[0][0],))
+    second.connection.rollback()
+    first.connection.commit()
+
+    cur.execute("SELECT claimed_by, count(*) FROM browser_tests GROUP BY claimed_by ORDER BY 1;")
+    assert cur.fetchall() == [('first', 2 * len(CONFIGURATIONS)), (None, 3 * len(CONFIGURATIONS))]
+    first.connection.close()
+    second.connection.close()
@@ -0,0 +1,21 @@
+from result_sink import ResultSink
+
+import crawl
+import json
+import time
+
+
+def test_flush_keeps_fetch_times(cur):
+    crawl.setup()
+    sink = ResultSink(max_rows=100, max_seconds=3600)
+    headers = json.dumps({'status_code': 200})
+    for crawl_try in range(3):
+        data = ['https://www.example.com/', '127.0.0.1:443', 'TLSv1.3', None, headers]
+        crawl.store_result(sink, cur, 'browser', dict(), 1, 'https://example.com/', crawl_try, data)
+        time.sleep(0.01)
+    # All rows are written by a single flush
+    sink.close()
+    cur.execute("SELECT timestamp FROM browser ORDER BY crawl_try;")
+    timestamps = [timestamp for timestamp, in cur.fetchall()]
+    assert len(timestamps) == 3
+    assert timestamps == sorted(set(timestamps))
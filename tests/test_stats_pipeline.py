@@ -0,0 +1,46 @@
+from body_store import GzipFileStore
+
+import stats_pipeline
+import body_store
+import functools
+import crawl
+import time
+
+
+def wait_for(condition, seconds=10):
+    deadline = time.time() + seconds
+    while not condition() and time.time() < deadline:
+        time.sleep(0.1)
+    return condition()
+
+
+def test_workers_submit_every_hash_once(cur, tmp_path, monkeypatch):
+    crawl.setup()
+    # The parsers are forked by start and load the bodies from this store
+    monkeypatch.setitem(body_store.BACKENDS, 'gzip', functools.partial(GzipFileStore, str(tmp_path)))
+    monkeypatch.setattr(body_store, '_stores', dict())
+    monkeypatch.setattr(stats_pipeline, 'STATS_SECONDS', 0)
+    content_hash = body_store.store_body(b'<html><head><title>Page</title></head><body><p>Hi</p></body></html>')
+    missing_hash = 'f' * 32
+    pipeline = stats_pipeline.StatsPipeline(processes=1)
+    pipeline.start()
+    submitted = list()
+    put = pipeline.queues[0].put
+    monkeypatch.setattr(pipeline.queues[0], 'put', lambda value: submitted.append(value) or put(value))
+    try:
+        for _ in range(70):
+            pipeline.submit(content_hash)
+            pipeline.submit(missing_hash)
+        assert submitted == [content_hash, missing_hash]
+        assert wait_for(lambda: content_hash in pipeline.reported)
+
+        # Once the resubmit time passed, only the hash that was never reported as stored is submitted again
+        monkeypatch.setattr(stats_pipeline, 'RESUBMIT_SECONDS', 0)
+        pipeline.submit(content_hash)
+        pipeline.submit(missing_hash)
+        assert submitted == [content_hash, missing_hash, missing_hash]
+        assert content_hash in pipeline.stored
+    finally:
+        pipeline.close()
+    cur.execute("SELECT file_name_hash FROM script_stats;")
+    assert cur.fetchall() == [(content_hash,)]